@@ -0,0 +1,140 @@
+"""
+Benchmark for the image decode/resize pipeline.
+Compares the previous approach (full decode, LANCZOS on the original, PNG output) with
+image_service.normalize_image. Each run happens in a fresh process; "peak RSS +MB" is
+how far the pipeline raised the process's peak memory above its state after imports.
+
+Usage:
+    python benchmark_images.py                 # synthetic 12 MP and 24 MP photos
+    python benchmark_images.py photo1.jpg ...  # your own files
+"""
+import ctypes
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+RUNS = 5
+
+def legacy_pipeline(content: bytes) -> bytes:
+    from PIL import Image
+    img = Image.open(BytesIO(content))
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    img = img.resize((800, 600), Image.Resampling.LANCZOS)
+    output = BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
+
+def normalized_pipeline(content: bytes) -> bytes:
+    from image_service import normalize_image
+    return normalize_image(content).getvalue()
+
+PIPELINES = {
+    "legacy": legacy_pipeline,
+    "normalized": normalized_pipeline
+}
+
+def _rss_mb() -> float:
+    """Current RSS on Linux; elsewhere the process peak (ru_maxrss, KB on Linux, bytes on macOS)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def _release_free_memory():
+    # Hand memory freed by imports back to the OS so it is not silently reused
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except OSError:
+        pass
+
+class RSSSampler(threading.Thread):
+    """Highest RSS seen while the pipeline runs."""
+    
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = _rss_mb()
+        self.stopped = threading.Event()
+    
+    def run(self):
+        while not self.stopped.wait(0.002):
+            self.peak = max(self.peak, _rss_mb())
+
+def run_one(pipeline: str, path: str):
+    """Child process: time one pipeline on one file and print JSON."""
+    # Import the service for both pipelines so module overhead is the same
+    import image_service  # noqa: F401
+    with open(path, "rb") as f:
+        content = f.read()
+    func = PIPELINES[pipeline]
+    
+    _release_free_memory()
+    baseline_rss = _rss_mb()
+    sampler = RSSSampler()
+    sampler.start()
+    try:
+        func(content)  # Warm up codecs
+    except ValueError as e:
+        print(json.dumps({"error": str(e)}))
+        return
+    cpu_times = []
+    for _ in range(RUNS):
+        started = time.process_time()
+        output = func(content)
+        cpu_times.append(time.process_time() - started)
+    sampler.stopped.set()
+    sampler.join()
+    
+    print(json.dumps({
+        "cpu_ms": round(min(cpu_times) * 1000, 1),
+        "peak_rss_mb": round(sampler.peak - baseline_rss, 1),
+        "output_kb": round(len(output) / 1024, 1)
+    }))
+
+def make_samples(directory: str) -> list:
+    """Noisy gradient photos at typical camera resolutions."""
+    from PIL import Image
+    paths = []
+    for width, height in ((4000, 3000), (6000, 4000)):
+        gradient = Image.linear_gradient("L").resize((width, height))
+        noise = Image.effect_noise((width, height), 20)
+        img = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+        path = os.path.join(directory, f"sample_{width}x{height}.jpg")
+        img.save(path, format="JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+def main(paths: list):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = paths or make_samples(directory)
+        print(f"{'image':<28}{'pipeline':<12}{'cpu ms':>9}{'peak RSS +MB':>14}{'output KB':>12}")
+        for path in paths:
+            for pipeline in PIPELINES:
+                result = subprocess.run(
+                    [sys.executable, __file__, "--child", pipeline, path],
+                    capture_output=True, text=True, check=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    env=dict(os.environ, IMAGE_CACHE_ENABLED="false")
+                )
+                stats = json.loads(result.stdout.strip().splitlines()[-1])
+                if "error" in stats:
+                    print(f"{os.path.basename(path):<28}{pipeline:<12}  rejected: {stats['error']}")
+                    continue
+                print(f"{os.path.basename(path):<28}{pipeline:<12}{stats['cpu_ms']:>9}"
+                      f"{stats['peak_rss_mb']:>14}{stats['output_kb']:>12}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_one(sys.argv[2], sys.argv[3])
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,175 @@
+"""
+Circuit breaker for outbound AI provider calls.
+Tracks a rolling window of outcomes and latencies per provider, opens after repeated
+failures so callers can route straight to a healthy provider, and lets a limited
+number of probe calls through (half-open) once the cool-down has passed.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_CONSECUTIVE_FAILURES = int(os.getenv("BREAKER_CONSECUTIVE_FAILURES", "3"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "15"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+
+class CircuitBreaker:
+    """Closed -> open -> half-open state machine for one provider."""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str,
+                 window_seconds: float = BREAKER_WINDOW_SECONDS,
+                 min_calls: int = BREAKER_MIN_CALLS,
+                 failure_rate_threshold: float = BREAKER_FAILURE_RATE,
+                 consecutive_failures: int = BREAKER_CONSECUTIVE_FAILURES,
+                 slow_call_seconds: float = BREAKER_SLOW_CALL_SECONDS,
+                 open_seconds: float = BREAKER_OPEN_SECONDS,
+                 half_open_probes: int = BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.consecutive_failures_threshold = consecutive_failures
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._consecutive_failures = 0
+        self._calls = deque()  # (timestamp, ok, latency)
+        self._cancelled = deque()  # (timestamp, latency) of calls abandoned before they finished
+        self._times_opened = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+    
+    def _trim(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window_seconds:
+            self._calls.popleft()
+        while self._cancelled and self._cancelled[0][0] < now - self.window_seconds:
+            self._cancelled.popleft()
+    
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes_in_flight = 0
+            print(f"ℹ Circuit for {self.name} half-open, probing")
+        return self._state
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+    
+    def allow_request(self) -> bool:
+        """Reserve a call. Every True must be followed by record_success/record_failure/release."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+            self._rejected += 1
+            return False
+    
+    def _open(self, now: float):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+        self._times_opened += 1
+        print(f"✗ Circuit for {self.name} opened for {self.open_seconds:.0f}s")
+    
+    def record_success(self, latency: float):
+        # Calls that succeed but take too long still count against the provider
+        if latency > self.slow_call_seconds:
+            self.record_failure(latency)
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, True, latency))
+            self._trim(now)
+            self._consecutive_failures = 0
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                self._probes_in_flight = 0
+                self._calls.clear()
+                self._calls.append((now, True, latency))
+                print(f"✓ Circuit for {self.name} closed")
+    
+    def record_failure(self, latency: float):
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, False, latency))
+            self._trim(now)
+            self._consecutive_failures += 1
+            state = self._current_state(now)
+            if state == self.HALF_OPEN:
+                self._open(now)
+                return
+            if state != self.CLOSED:
+                return
+            failures = sum(1 for _, ok, _ in self._calls if not ok)
+            if (self._consecutive_failures >= self.consecutive_failures_threshold or
+                    (len(self._calls) >= self.min_calls and
+                     failures / len(self._calls) >= self.failure_rate_threshold)):
+                self._open(now)
+    
+    def release(self, latency: float = None):
+        """Give back a reserved call whose outcome says nothing about provider health (e.g. cancelled).
+        
+        latency is how long a call ran before it was abandoned; it is kept as a latency sample
+        (the call took at least that long) without counting as a success or failure.
+        """
+        with self._lock:
+            if latency is not None:
+                now = time.monotonic()
+                self._cancelled.append((now, latency))
+                self._trim(now)
+            if self._state == self.HALF_OPEN and self._probes_in_flight > 0:
+                self._probes_in_flight -= 1
+    
+    def latency_percentile(self, percentile: float, successful_only: bool = True):
+        """Latency percentile (0-100) over the rolling window, or None without samples.
+        
+        Abandoned calls are included, otherwise calls that lost a race would be missing
+        and the percentile would only describe the fast ones.
+        """
+        with self._lock:
+            self._trim(time.monotonic())
+            samples = [latency for _, ok, latency in self._calls if ok or not successful_only]
+            samples = sorted(samples + [latency for _, latency in self._cancelled])
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+        return samples[index]
+    
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            state = self._current_state(now)
+            calls = len(self._calls)
+            failures = sum(1 for _, ok, _ in self._calls if not ok)
+            latencies = [latency for _, ok, latency in self._calls if ok]
+            cancelled = len(self._cancelled)
+        p95 = self.latency_percentile(95)
+        return {
+            "state": state,
+            "window_calls": calls,
+            "window_failures": failures,
+            "window_cancelled": cancelled,
+            "error_rate": round(failures / calls, 3) if calls else 0.0,
+            "avg_latency_seconds": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "p95_latency_seconds": round(p95, 3) if p95 is not None else None,
+            "times_opened": self._times_opened,
+            "rejected_calls": self._rejected
+        }
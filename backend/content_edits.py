@@ -0,0 +1,78 @@
+"""
+Block-level edits for section content.
+Content is split into numbered blocks (paragraphs for documents, bullets for slides) so a
+refinement can send only the blocks it touches and the model can answer with edits
+that are applied back onto the stored text.
+"""
+import re
+from typing import List, Optional, Tuple
+
+EDIT_MARKER = re.compile(r"^\s*\[(\+?)(\d+)\]\s*$", re.MULTILINE)
+PREVIEW_WORDS = 12
+
+def split_blocks(content: str) -> Tuple[List[str], str]:
+    """Split content into blocks and return them with the separator used to join them."""
+    text = (content or "").strip("\n")
+    if re.search(r"\n\s*\n", text):
+        blocks = [block.strip("\n").rstrip() for block in re.split(r"\n\s*\n", text)]
+        return [block for block in blocks if block.strip()], "\n\n"
+    return [line.rstrip() for line in text.split("\n") if line.strip()], "\n"
+
+def join_blocks(blocks: List[str], separator: str) -> str:
+    return separator.join(blocks)
+
+def preview_block(block: str, words: int = PREVIEW_WORDS) -> str:
+    """First few words of a block, enough for the model to see what surrounds its edit."""
+    parts = block.split()
+    if len(parts) <= words:
+        return " ".join(parts)
+    return " ".join(parts[:words]) + " …"
+
+def parse_edits(response: str) -> list:
+    """Parse '[n]' (replace/delete) and '[+n]' (insert after n) edits from a model answer."""
+    markers = list(EDIT_MARKER.finditer(response or ""))
+    edits = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(response)
+        text = response[marker.end():end].strip("\n").rstrip()
+        index = int(marker.group(2))
+        if marker.group(1):
+            edits.append(("insert", index, text))
+        elif text.strip().upper() == "DELETE":
+            edits.append(("delete", index, ""))
+        else:
+            edits.append(("replace", index, text))
+    return edits
+
+def apply_edits(blocks: List[str], edits: list, editable: Optional[set] = None) -> Tuple[List[str], int]:
+    """
+    Apply parsed edits to 1-based blocks. Replacements and deletions of blocks outside
+    `editable` (when given) are ignored, since the model only saw a preview of them.
+    Returns the new blocks and the number of edits applied.
+    """
+    replaced = {}
+    deleted = set()
+    inserted = {}
+    applied = 0
+    for kind, index, text in edits:
+        if kind == "insert":
+            if 0 <= index <= len(blocks) and text.strip():
+                inserted.setdefault(index, []).append(text)
+                applied += 1
+            continue
+        if not 1 <= index <= len(blocks) or (editable is not None and index not in editable):
+            continue
+        if kind == "delete":
+            deleted.add(index)
+        elif text.strip():
+            replaced[index] = text
+        else:
+            continue
+        applied += 1
+
+    result = list(inserted.get(0, []))
+    for index, block in enumerate(blocks, 1):
+        if index not in deleted:
+            result.append(replaced.get(index, block))
+        result.extend(inserted.get(index, []))
+    return result, applied
@@ -1,21 +1,250 @@
 from docx import Document
-from docx.shared import Pt, Inches as DocxInches
+from docx.shared import Pt, Inches as DocxInches, RGBColor as DocxRGBColor
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 from pptx import Presentation
 from pptx.util import Inches, Pt as PptxPt
 from pptx.enum.text import PP_ALIGN, MSO_ANCHOR
 from pptx.enum.shapes import MSO_SHAPE
 from pptx.dml.color import RGBColor
-from io import BytesIO
-from typing import List, Dict, Any
+import hashlib
+import json
+import os
+import tempfile
+from typing import List, Dict, Any, BinaryIO
 from models import Project, Section
-from image_service import image_service
+from image_service import image_service, IMAGE_RENDER_DPI, DedupScope, SlideClaims
 from theme_service import theme_service
+from export_cache import export_cache
+from slide_cache import slide_cache, SlideCache
+
+MEDIA_TYPES = {
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+}
+
+# Part of every export cache key; bump whenever a change here alters the rendered file
+RENDERER_VERSION = "2.2"
+
+# Exports are written to a temp file that stays in memory only up to this size
+EXPORT_SPOOL_MAX_BYTES = int(float(os.getenv("EXPORT_SPOOL_MAX_MB", "1")) * 1024 * 1024)
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def iter_file(file: BinaryIO, chunk_size: int = EXPORT_CHUNK_BYTES):
+    """Read a rendered export in fixed-size chunks for a streaming response, then close it."""
+    try:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        file.close()
+
+class RenderStyle:
+    """
+    Theme colors, font and alignment of one export, resolved once: hex colors parsed into
+    the target library's RGBColor and alignment names mapped to enums, so the render loops
+    only assign precomputed values.
+    """
+    
+    # Built-in PowerPoint fonts offered by the editor
+    PPTX_FONTS = {
+        'arial': 'Arial',
+        'helvetica': 'Helvetica',
+        'georgia': 'Georgia',
+        'times': 'Times New Roman',
+        'courier': 'Courier New',
+        'verdana': 'Verdana'
+    }
+    PPTX_ALIGNMENTS = {
+        'left': PP_ALIGN.LEFT,
+        'center': PP_ALIGN.CENTER,
+        'right': PP_ALIGN.RIGHT
+    }
+    DOCX_ALIGNMENTS = {
+        'left': WD_ALIGN_PARAGRAPH.LEFT,
+        'center': WD_ALIGN_PARAGRAPH.CENTER,
+        'right': WD_ALIGN_PARAGRAPH.RIGHT,
+        'justify': WD_ALIGN_PARAGRAPH.JUSTIFY
+    }
+    
+    def __init__(self, colors: Dict[str, str], rgb_class, font_name: str, font_size: int,
+                 alignment_name: str, alignment, image_alignment: str):
+        self.colors = colors
+        # e.g. style.primary_rgb, style.text_rgb
+        for name, hex_color in colors.items():
+            setattr(self, f"{name}_rgb", rgb_class(*DocumentServiceV2._hex_to_rgb(hex_color)))
+        self.font_name = font_name
+        self.font_size = font_size
+        self.alignment_name = alignment_name
+        self.alignment = alignment
+        self.image_alignment = image_alignment
+        # Gradient for image placeholders, in the theme's colors
+        self.placeholder_colors = (
+            DocumentServiceV2._hex_to_rgb(colors["primary"]),
+            DocumentServiceV2._hex_to_rgb(colors["secondary"])
+        )
+    
+    @classmethod
+    def for_pptx(cls, metadata: Dict[str, Any] = None) -> "RenderStyle":
+        theme = metadata.get('theme', {}) if metadata else {}
+        text_style = metadata.get('textStyle', {}) if metadata else {}
+        preview = theme.get('preview', {})
+        alignment = text_style.get('alignment', 'left')
+        return cls(
+            colors={
+                "primary": preview.get('primary', '#667eea'),
+                "secondary": preview.get('secondary', '#764ba2'),
+                "text": preview.get('text', '#ffffff')
+            },
+            rgb_class=RGBColor,
+            font_name=cls.PPTX_FONTS.get(text_style.get('fontFamily', 'arial'), 'Arial'),
+            font_size=16,
+            alignment_name=alignment,
+            alignment=cls.PPTX_ALIGNMENTS.get(alignment, PP_ALIGN.LEFT),
+            image_alignment=text_style.get('imageAlignment', 'top')
+        )
+    
+    @classmethod
+    def for_docx(cls, metadata: Dict[str, Any] = None) -> "RenderStyle":
+        theme = metadata.get('theme', {}) if metadata else {}
+        text_style = metadata.get('textStyle', {}) if metadata else {}
+        preview = theme.get('preview', {}) if theme else {}
+        font_name = text_style.get('fontFamily', 'calibri').title()
+        if font_name == 'Times': font_name = 'Times New Roman'
+        elif font_name == 'Courier': font_name = 'Courier New'
+        alignment = text_style.get('alignment', 'left')
+        return cls(
+            colors={
+                "primary": preview.get('primary', '#0078D4'),
+                "secondary": preview.get('secondary', '#106EBE'),
+                "accent": preview.get('accent', '#50E6FF')
+            },
+            rgb_class=DocxRGBColor,
+            font_name=font_name,
+            font_size=text_style.get('fontSize', 12),
+            alignment_name=alignment,
+            alignment=cls.DOCX_ALIGNMENTS.get(alignment, WD_ALIGN_PARAGRAPH.LEFT),
+            image_alignment=text_style.get('imageAlignment', 'top')
+        )
+    
+    def cache_key(self) -> dict:
+        """Everything about the style that changes rendered output, for cache keys."""
+        return {
+            "colors": self.colors,
+            "font": self.font_name,
+            "size": self.font_size,
+            "align": self.alignment_name,
+            "image_alignment": self.image_alignment
+        }
 
 class DocumentServiceV2:
     """Improved PowerPoint generation with better formatting and layout."""
     
     @staticmethod
-    def create_professional_pptx(project: Project, sections: List[Section], metadata: Dict[str, Any] = None) -> BytesIO:
+    def parse_metadata(project: Project) -> Dict[str, Any]:
+        """Theme and text style stored on the project, or None."""
+        if not project.metadata_json:
+            return None
+        try:
+            return json.loads(project.metadata_json)
+        except:
+            return None
+    
+    @staticmethod
+    def export_format(project: Project):
+        """(extension, filename, media_type) of a project's export."""
+        extension = "docx" if project.document_type == "docx" else "pptx"
+        return extension, f"{project.title}.{extension}", MEDIA_TYPES[extension]
+    
+    @staticmethod
+    def export_etag(project: Project, sections: List[Section]) -> str:
+        """
+        Content hash of everything that changes the exported file: project text, section
+        order/titles/content, metadata (theme and text style), the custom theme template's
+        mtime and the renderer version.
+        """
+        extension = DocumentServiceV2.export_format(project)[0]
+        metadata = DocumentServiceV2.parse_metadata(project) or {}
+        theme_id = metadata.get('theme', {}).get('id')
+        template_path = theme_service.get_template_path(theme_id, extension) if theme_id else None
+        
+        payload = json.dumps({
+            "renderer": RENDERER_VERSION,
+            "dpi": IMAGE_RENDER_DPI,
+            "type": extension,
+            "title": project.title,
+            "topic": project.main_topic,
+            "metadata": project.metadata_json,
+            "template_mtime": os.path.getmtime(template_path) if template_path else None,
+            "sections": [
+                [section.order, section.title, section.content]
+                for section in sorted(sections, key=lambda x: x.order)
+            ]
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def _save(package, output: BinaryIO = None) -> BinaryIO:
+        """
+        Write a Presentation/Document into `output`, or a spooled temp file that moves to
+        disk past EXPORT_SPOOL_MAX_BYTES, and rewind it.
+        """
+        if output is None:
+            output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+        package.save(output)
+        output.seek(0)
+        return output
+    
+    @staticmethod
+    def export_project(project: Project, sections: List[Section], output: BinaryIO = None):
+        """
+        Render a project in its document format into `output` (a spooled temp file by
+        default). Returns (file_stream, filename, media_type).
+        """
+        metadata = DocumentServiceV2.parse_metadata(project)
+        
+        if project.document_type == "docx":
+            file_stream = DocumentServiceV2.create_docx(project, sections, metadata, output)
+        else:
+            file_stream = DocumentServiceV2.create_professional_pptx(project, sections, metadata, output)
+        
+        _, filename, media_type = DocumentServiceV2.export_format(project)
+        return file_stream, filename, media_type
+    
+    @staticmethod
+    def export_project_cached(project: Project, sections: List[Section]):
+        """
+        Rendered export from the export cache, rendering and storing it on a miss.
+        Returns (file, etag, filename, media_type) where file is the cached file's path, or
+        the freshly rendered stream when the cache is disabled or unwritable.
+        """
+        extension, filename, media_type = DocumentServiceV2.export_format(project)
+        etag = DocumentServiceV2.export_etag(project, sections)
+        if export_cache:
+            path = export_cache.get(etag, extension)
+            if path:
+                print(f"✓ Export cache hit for project {project.id}")
+                return path, etag, filename, media_type
+        
+        if export_cache:
+            try:
+                # Render straight into the cache file, no in-memory copy of the package
+                with export_cache.writer(etag, extension) as output:
+                    DocumentServiceV2.export_project(project, sections, output)
+                return export_cache.path(etag, extension), etag, filename, media_type
+            except OSError as e:
+                print(f"✗ Export cache write error: {e}")
+        
+        file_stream, _, _ = DocumentServiceV2.export_project(project, sections)
+        return file_stream, etag, filename, media_type
+    
+    @staticmethod
+    def create_professional_pptx(project: Project, sections: List[Section], metadata: Dict[str, Any] = None,
+                                 output: BinaryIO = None) -> BinaryIO:
         """Create a professional PowerPoint presentation using built-in layouts or custom themes."""
         # Extract theme preference
         theme = metadata.get('theme', {}) if metadata else {}
@@ -48,58 +277,56 @@ class DocumentServiceV2:
         # 7: Content with Caption
         # 8: Picture with Caption
         
-        # Extract styling
-        theme = metadata.get('theme', {}) if metadata else {}
-        text_style = metadata.get('textStyle', {}) if metadata else {}
-        
-        primary_color = theme.get('preview', {}).get('primary', '#667eea')
-        secondary_color = theme.get('preview', {}).get('secondary', '#764ba2')
-        text_color = theme.get('preview', {}).get('text', '#ffffff')
-        
-        font_family = text_style.get('fontFamily', 'arial')
-        alignment = text_style.get('alignment', 'left')
-        image_alignment = text_style.get('imageAlignment', 'top')
-        
-        # Font mapping
-        font_map = {
-            'arial': 'Arial',
-            'helvetica': 'Helvetica',
-            'georgia': 'Georgia',
-            'times': 'Times New Roman',
-            'courier': 'Courier New',
-            'verdana': 'Verdana'
-        }
-        font_name = font_map.get(font_family, 'Arial')
-        
-        # Alignment mapping
-        align_map = {
-            'left': PP_ALIGN.LEFT,
-            'center': PP_ALIGN.CENTER,
-            'right': PP_ALIGN.RIGHT
-        }
-        text_align = align_map.get(alignment, PP_ALIGN.LEFT)
+        # Colors, font and alignment resolved once for every slide
+        style = RenderStyle.for_pptx(metadata)
         
         # Create title slide
-        DocumentServiceV2._create_title_slide(
-            prs, project, primary_color, secondary_color, text_color, font_name
-        )
+        DocumentServiceV2._create_title_slide(prs, project, style)
+        
+        # Unchanged slides are spliced from the slide cache; only the rest are rendered
+        ordered_sections = sorted(sections, key=lambda x: x.order)
+        template_path = theme_service.get_template_path(theme_id) if theme_id else None
+        slide_style = {
+            "renderer": RENDERER_VERSION,
+            "topic": project.main_topic,
+            "template": [template_path, os.path.getmtime(template_path)] if template_path else None,
+            "size": [prs.slide_width, prs.slide_height],
+            "style": style.cache_key()
+        }
+        slide_keys = [SlideCache.make_key(section, slide_style) for section in ordered_sections]
+        cached_slides = [slide_cache.get(key) if slide_cache else None for key in slide_keys]
+        
+        # Resolve the images of slides to render up front, in parallel. Images already in
+        # spliced slides are claimed first so rendered slides don't repeat them
+        to_render = [section for section, entry in zip(ordered_sections, cached_slides) if entry is None]
+        dedup = DedupScope()
+        for entry in cached_slides:
+            for url in entry["images"] if entry else ():
+                dedup.claim(url)
+        scopes = [SlideClaims(dedup) for _ in to_render]
+        images = iter(zip(image_service.prefetch_images(
+            [section.title for section in to_render], project.main_topic, style.placeholder_colors, scopes
+        ), scopes))
+        if slide_cache:
+            print(f"ℹ Slide cache: {len(ordered_sections) - len(to_render)} reused, {len(to_render)} to render")
         
         # Create content slides
-        for section in sorted(sections, key=lambda x: x.order):
-            DocumentServiceV2._create_content_slide(
-                prs, section, project.main_topic,
-                primary_color, secondary_color, text_color,
-                font_name, text_align, image_alignment
-            )
-        
-        # Save to BytesIO
-        file_stream = BytesIO()
-        prs.save(file_stream)
-        file_stream.seek(0)
-        return file_stream
+        for section, key, entry in zip(ordered_sections, slide_keys, cached_slides):
+            if entry is not None:
+                SlideCache.splice(prs, entry)
+                continue
+            image_data, claims = next(images)
+            slide = DocumentServiceV2._create_content_slide(prs, section, image_data, style)
+            if slide_cache:
+                try:
+                    slide_cache.put(key, slide, prs.slide_layouts.index(slide.slide_layout), claims.urls)
+                except Exception as e:
+                    print(f"✗ Slide cache write error: {e}")
+        
+        return DocumentServiceV2._save(prs, output)
     
     @staticmethod
-    def _create_title_slide(prs, project, primary_color, secondary_color, text_color, font_name):
+    def _create_title_slide(prs, project, style: RenderStyle):
         """Create an attractive title slide using built-in layout."""
         # Use Title Slide layout (layout 0)
         slide = prs.slides.add_slide(prs.slide_layouts[0])
@@ -109,8 +336,8 @@ class DocumentServiceV2:
         fill = background.fill
         fill.gradient()
         fill.gradient_angle = 45
-        fill.gradient_stops[0].color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(primary_color))
-        fill.gradient_stops[1].color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(secondary_color))
+        fill.gradient_stops[0].color.rgb = style.primary_rgb
+        fill.gradient_stops[1].color.rgb = style.secondary_rgb
         
         # Use built-in title placeholder
         title_shape = slide.shapes.title
@@ -121,8 +348,8 @@ class DocumentServiceV2:
         title_para = title_frame.paragraphs[0]
         title_para.font.size = PptxPt(54)
         title_para.font.bold = True
-        title_para.font.name = font_name
-        title_para.font.color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(text_color))
+        title_para.font.name = style.font_name
+        title_para.font.color.rgb = style.text_rgb
         title_para.alignment = PP_ALIGN.CENTER
         
         # Always add a relevant subtitle
@@ -138,15 +365,15 @@ class DocumentServiceV2:
                 subtitle_frame = shape.text_frame
                 subtitle_para = subtitle_frame.paragraphs[0]
                 subtitle_para.font.size = PptxPt(24)
-                subtitle_para.font.name = font_name
-                subtitle_para.font.color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(text_color))
+                subtitle_para.font.name = style.font_name
+                subtitle_para.font.color.rgb = style.text_rgb
                 subtitle_para.alignment = PP_ALIGN.CENTER
                 break
     
     @staticmethod
-    def _create_content_slide(prs, section, main_topic, primary_color, secondary_color, 
-                             text_color, font_name, text_align, image_alignment):
+    def _create_content_slide(prs, section, image_data, style: RenderStyle):
         """Create a content slide using built-in Title and Content layout."""
+        image_alignment = style.image_alignment
         # Use Title and Content layout (layout 1) or Picture with Caption (layout 8)
         if image_alignment in ['left', 'right']:
             slide = prs.slides.add_slide(prs.slide_layouts[3])  # Two Content layout
@@ -158,8 +385,8 @@ class DocumentServiceV2:
         fill = background.fill
         fill.gradient()
         fill.gradient_angle = 45
-        fill.gradient_stops[0].color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(primary_color))
-        fill.gradient_stops[1].color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(secondary_color))
+        fill.gradient_stops[0].color.rgb = style.primary_rgb
+        fill.gradient_stops[1].color.rgb = style.secondary_rgb
         
         # Use built-in title placeholder
         title_shape = slide.shapes.title
@@ -170,8 +397,8 @@ class DocumentServiceV2:
         title_para = title_frame.paragraphs[0]
         title_para.font.size = PptxPt(36)
         title_para.font.bold = True
-        title_para.font.name = font_name
-        title_para.font.color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(text_color))
+        title_para.font.name = style.font_name
+        title_para.font.color.rgb = style.text_rgb
         title_para.alignment = PP_ALIGN.LEFT
         
         # Find content placeholder by index
@@ -204,6 +431,8 @@ class DocumentServiceV2:
                     # Content stays at top, image will be placed below
                     pass
                 
+                body_size = PptxPt(style.font_size)  # Slightly smaller font
+                spacing = PptxPt(4)  # Reduced spacing
                 for i, line in enumerate(lines):
                     if i == 0:
                         p = text_frame.paragraphs[0]
@@ -211,20 +440,20 @@ class DocumentServiceV2:
                         p = text_frame.add_paragraph()
                     
                     p.text = line
-                    p.font.size = PptxPt(16)  # Slightly smaller font
-                    p.font.name = font_name
-                    p.font.color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(text_color))
-                    p.alignment = text_align
-                    p.space_before = PptxPt(4)  # Reduced spacing
-                    p.space_after = PptxPt(4)
+                    p.font.size = body_size
+                    p.font.name = style.font_name
+                    p.font.color.rgb = style.text_rgb
+                    p.alignment = style.alignment
+                    p.space_before = spacing
+                    p.space_after = spacing
                     p.level = 0
             else:
                 # If no content, add a message
                 p = text_frame.paragraphs[0]
                 p.text = "No content available"
                 p.font.size = PptxPt(18)
-                p.font.name = font_name
-                p.font.color.rgb = RGBColor(*DocumentServiceV2._hex_to_rgb(text_color))
+                p.font.name = style.font_name
+                p.font.color.rgb = style.text_rgb
         
         # Calculate text content height for dynamic image sizing
         text_height = 0
@@ -235,11 +464,8 @@ class DocumentServiceV2:
             line_height = PptxPt(16 + 8)  # font size + spacing
             text_height = num_lines * line_height
         
-        # Add image for ALL layouts with dynamic sizing
+        # Add image for ALL layouts with dynamic sizing (fetched during prefetch)
         try:
-            print(f"\n🖼️  Fetching image for slide: '{section.title}' (text lines: {num_lines})")
-            image_data = image_service.generate_slide_image(section.title, main_topic)
-            
             if image_data:
                 print(f"✓ Image data received, calculating optimal size...")
                 
@@ -257,7 +483,10 @@ class DocumentServiceV2:
                             sp = shape.element
                             sp.getparent().remove(sp)
                             
-                            slide.shapes.add_picture(image_data, left, top, width=width, height=height)
+                            slide.shapes.add_picture(
+                                image_service.render_for_slot(image_data, width, height),
+                                left, top, width=width, height=height
+                            )
                             print(f"✓ Image added to {image_alignment} layout (size: {width/914400:.1f}x{height/914400:.1f} inches)")
                             break
                 else:
@@ -265,7 +494,7 @@ class DocumentServiceV2:
                     dims = DocumentServiceV2._calculate_image_dimensions(prs, num_lines, image_alignment)
                     
                     slide.shapes.add_picture(
-                        image_data, 
+                        image_service.render_for_slot(image_data, dims['width'], dims['height']),
                         dims['left'], 
                         dims['top'], 
                         width=dims['width'], 
@@ -276,6 +505,8 @@ class DocumentServiceV2:
                 print(f"✗ No image data received for '{section.title}'")
         except Exception as e:
             print(f"✗ Image error for '{section.title}': {e}")
+        
+        return slide
     
     @staticmethod
     def _calculate_image_dimensions(prs, num_lines, image_alignment):
@@ -433,7 +664,7 @@ class DocumentServiceV2:
             para = doc.add_paragraph()
             para.alignment = 1  # Center alignment
             run = para.add_run()
-            run.add_picture(image_data, width=width, height=height)
+            run.add_picture(image_service.render_for_slot(image_data, width, height), width=width, height=height)
             print(f"✓ Image added to document (width: {width/914400:.1f}\", height: {height/914400:.1f}\")")
         except Exception as e:
             print(f"✗ Failed to add image to document: {e}")
@@ -445,65 +676,124 @@ class DocumentServiceV2:
         return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
     
     @staticmethod
-    def _apply_document_theme(doc, font_name, primary_rgb, secondary_rgb, accent_rgb):
+    def _apply_document_theme(doc, style: RenderStyle):
         """Apply theme colors to document styles."""
-        from docx.shared import RGBColor as DocxRGBColor
-        
         try:
             # Update Heading 1 style
             if 'Heading 1' in doc.styles:
                 heading1_style = doc.styles['Heading 1']
-                heading1_style.font.color.rgb = DocxRGBColor(*accent_rgb)
-                heading1_style.font.name = font_name
+                heading1_style.font.color.rgb = style.accent_rgb
+                heading1_style.font.name = style.font_name
                 heading1_style.font.size = Pt(18)
                 heading1_style.font.bold = True
             
             # Update Title style
             if 'Title' in doc.styles:
                 title_style = doc.styles['Title']
-                title_style.font.color.rgb = DocxRGBColor(*primary_rgb)
-                title_style.font.name = font_name
+                title_style.font.color.rgb = style.primary_rgb
+                title_style.font.name = style.font_name
                 title_style.font.size = Pt(28)
                 title_style.font.bold = True
             
             # Update Normal style
             if 'Normal' in doc.styles:
                 normal_style = doc.styles['Normal']
-                normal_style.font.name = font_name
+                normal_style.font.name = style.font_name
                 normal_style.font.size = Pt(12)
         except Exception as e:
             print(f"Warning: Could not apply document theme: {e}")
-
+    
+    # Paragraph properties that come after w:shd in CT_PPr
+    SHADING_SUCCESSORS = (
+        'w:tabs', 'w:suppressAutoHyphens', 'w:kinsoku', 'w:wordWrap', 'w:overflowPunct',
+        'w:topLinePunct', 'w:autoSpaceDE', 'w:autoSpaceDN', 'w:bidi', 'w:adjustRightInd',
+        'w:snapToGrid', 'w:spacing', 'w:ind', 'w:contextualSpacing', 'w:mirrorIndents',
+        'w:suppressOverlap', 'w:jc', 'w:textDirection', 'w:textAlignment', 'w:textboxTightWrap',
+        'w:outlineLvl', 'w:divId', 'w:cnfStyle', 'w:rPr', 'w:sectPr', 'w:pPrChange'
+    )
+    
     @staticmethod
-    def create_docx(project: Project, sections: List[Section], metadata: Dict[str, Any] = None) -> BytesIO:
+    def _paragraph_style(doc, name, font_name, size=None, bold=None, color=None,
+                         alignment=None, space_before=None, space_after=None, shading=None):
+        """Add (or update, for templates that already have it) a named paragraph style based on Normal."""
+        if name in doc.styles:
+            paragraph_style = doc.styles[name]
+        else:
+            paragraph_style = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+            paragraph_style.base_style = doc.styles['Normal']
+            paragraph_style.quick_style = True
+        
+        paragraph_style.font.name = font_name
+        if size is not None:
+            paragraph_style.font.size = Pt(size)
+        if bold is not None:
+            paragraph_style.font.bold = bold
+        if color is not None:
+            paragraph_style.font.color.rgb = color
+        paragraph_format = paragraph_style.paragraph_format
+        if alignment is not None:
+            paragraph_format.alignment = alignment
+        if space_before is not None:
+            paragraph_format.space_before = Pt(space_before)
+        if space_after is not None:
+            paragraph_format.space_after = Pt(space_after)
+        if shading:
+            # Background color of the whole paragraph
+            pPr = paragraph_style.element.get_or_add_pPr()
+            for existing in pPr.findall(qn('w:shd')):
+                pPr.remove(existing)
+            shading_elm = OxmlElement('w:shd')
+            shading_elm.set(qn('w:val'), 'clear')
+            shading_elm.set(qn('w:fill'), shading.lstrip('#'))
+            # Word expects pPr children in schema order
+            pPr.insert_element_before(shading_elm, *DocumentServiceV2.SHADING_SUCCESSORS)
+        return paragraph_style
+    
+    @staticmethod
+    def _add_paragraph(container, text, style_id):
+        """Add a paragraph by style id; python-docx's style= argument looks the style up on every call."""
+        para = container.add_paragraph(text)
+        para._p.get_or_add_pPr().style = style_id
+        return para
+    
+    @staticmethod
+    def _add_export_styles(doc, style: RenderStyle) -> dict:
+        """
+        Named styles for the title banner, separator, section headings and body text, defined
+        once per document. Returns their style ids.
+        """
+        white = DocxRGBColor(255, 255, 255)
+        paragraph_styles = {
+            "title": DocumentServiceV2._paragraph_style(
+                doc, "Export Title", style.font_name, size=28, bold=True, color=white,
+                alignment=WD_ALIGN_PARAGRAPH.CENTER, space_before=12, space_after=12,
+                shading=style.colors["primary"]
+            ),
+            "separator": DocumentServiceV2._paragraph_style(
+                doc, "Export Separator", style.font_name, color=style.primary_rgb,
+                alignment=WD_ALIGN_PARAGRAPH.CENTER
+            ),
+            "heading": DocumentServiceV2._paragraph_style(
+                doc, "Export Heading", style.font_name, size=18, bold=True, color=white,
+                space_before=12, space_after=6, shading=style.colors["accent"]
+            ),
+            "body": DocumentServiceV2._paragraph_style(
+                doc, "Export Body", style.font_name, size=style.font_size, alignment=style.alignment
+            )
+        }
+        return {name: paragraph_style.style_id for name, paragraph_style in paragraph_styles.items()}
+    
+    @staticmethod
+    def create_docx(project: Project, sections: List[Section], metadata: Dict[str, Any] = None,
+                    output: BinaryIO = None) -> BinaryIO:
         """Create a Word document from project data with theme and style support."""
-        from docx.shared import RGBColor as DocxRGBColor
-        
-        # Extract theme and text style preferences
+        # Extract theme preference
         theme = metadata.get('theme', {}) if metadata else {}
-        text_style = metadata.get('textStyle', {}) if metadata else {}
         theme_id = theme.get('id', None)
-        theme_preview = theme.get('preview', {}) if theme else {}
         
-        # Get theme colors
-        primary_color = theme_preview.get('primary', '#0078D4')
-        secondary_color = theme_preview.get('secondary', '#106EBE')
-        accent_color = theme_preview.get('accent', '#50E6FF')
-        
-        # Convert hex to RGB
-        primary_rgb = DocumentServiceV2._hex_to_rgb(primary_color)
-        secondary_rgb = DocumentServiceV2._hex_to_rgb(secondary_color)
-        accent_rgb = DocumentServiceV2._hex_to_rgb(accent_color)
-        
-        # Text style settings
-        font_name = text_style.get('fontFamily', 'calibri').title()
-        if font_name == 'Times': font_name = 'Times New Roman'
-        elif font_name == 'Courier': font_name = 'Courier New'
-        
-        font_size = text_style.get('fontSize', 12)
-        alignment_map = {'left': 0, 'center': 1, 'right': 2, 'justify': 3}
-        text_alignment = alignment_map.get(text_style.get('alignment', 'left'), 0)
-        image_alignment = text_style.get('imageAlignment', 'top')
+        # Colors, font and alignment resolved once for the whole document
+        style = RenderStyle.for_docx(metadata)
+        image_alignment = style.image_alignment
         
         # Try to load custom theme template
         if theme_id:
@@ -516,81 +806,28 @@ class DocumentServiceV2:
         else:
             doc = Document()
         
-        # Apply document-level theme
-        DocumentServiceV2._apply_document_theme(doc, font_name, primary_rgb, secondary_rgb, accent_rgb)
-        
-        # Create styled header section with theme colors
-        from docx.oxml.ns import qn
-        from docx.oxml import OxmlElement
-        
-        # Add title with theme background
-        title_para = doc.add_paragraph()
-        title_para.alignment = 1  # Center alignment
-        
-        # Add shading (background color) to title paragraph
-        try:
-            shading_elm = OxmlElement('w:shd')
-            shading_elm.set(qn('w:fill'), primary_color.lstrip('#'))
-            title_para._element.get_or_add_pPr().append(shading_elm)
-        except:
-            pass
-        
-        # Add title text
-        title_run = title_para.add_run(project.title)
-        title_run.font.color.rgb = DocxRGBColor(255, 255, 255)  # White text on colored background
-        title_run.font.bold = True
-        title_run.font.size = Pt(28)
-        title_run.font.name = font_name
+        # Apply document-level theme, then the styles every paragraph below refers to
+        DocumentServiceV2._apply_document_theme(doc, style)
+        styles = DocumentServiceV2._add_export_styles(doc, style)
         
-        # Add spacing before and after
-        title_para.paragraph_format.space_before = Pt(12)
-        title_para.paragraph_format.space_after = Pt(12)
-        
-
-        
-
+        # Title banner in the theme's primary color
+        DocumentServiceV2._add_paragraph(doc, project.title, styles["title"])
         
         # Add a horizontal line separator
-        separator = doc.add_paragraph()
-        separator_run = separator.add_run('_' * 80)
-        separator_run.font.color.rgb = DocxRGBColor(*primary_rgb)
-        separator.alignment = 1
+        DocumentServiceV2._add_paragraph(doc, '_' * 80, styles["separator"])
         
         doc.add_paragraph()  # Empty line
         
+        # Resolve every section image up front, in parallel
+        ordered_sections = sorted(sections, key=lambda x: x.order)
+        images = image_service.prefetch_images(
+            [section.title for section in ordered_sections], project.main_topic, style.placeholder_colors
+        )
+        
         # Add sections with custom styling and images
-        for section in sorted(sections, key=lambda x: x.order):
-            # Section heading with theme color and background
-            heading = doc.add_paragraph()
-            
-            # Add background color to section heading
-            try:
-                from docx.oxml.ns import qn
-                from docx.oxml import OxmlElement
-                shading_elm = OxmlElement('w:shd')
-                shading_elm.set(qn('w:fill'), accent_color.lstrip('#'))
-                heading._element.get_or_add_pPr().append(shading_elm)
-            except:
-                pass
-            
-            heading_run = heading.add_run(section.title)
-            heading_run.font.color.rgb = DocxRGBColor(255, 255, 255)  # White text
-            heading_run.font.bold = True
-            heading_run.font.size = Pt(18)
-            heading_run.font.name = font_name
-            
-            heading.paragraph_format.space_before = Pt(12)
-            heading.paragraph_format.space_after = Pt(6)
-            
-            # Fetch image for this section
-            print(f"\n🖼️  Fetching image for section: '{section.title}'")
-            image_data = None
-            try:
-                image_data = image_service.generate_slide_image(section.title, project.main_topic)
-                if image_data:
-                    print(f"✓ Image data received for '{section.title}'")
-            except Exception as e:
-                print(f"✗ Image fetch failed for '{section.title}': {e}")
+        for section, image_data in zip(ordered_sections, images):
+            # Section heading on the theme's accent color
+            DocumentServiceV2._add_paragraph(doc, section.title, styles["heading"])
             
             # Clean content for Word documents (no line limits)
             lines = DocumentServiceV2._clean_content_for_word(section.content, section_title=section.title)
@@ -602,20 +839,12 @@ class DocumentServiceV2:
                 doc.add_paragraph()  # Space after image
                 
                 for line in lines:
-                    para = doc.add_paragraph(line)
-                    para.alignment = text_alignment
-                    for run in para.runs:
-                        run.font.name = font_name
-                        run.font.size = Pt(font_size)
+                    DocumentServiceV2._add_paragraph(doc, line, styles["body"])
             
             elif image_alignment == 'bottom' and image_data:
                 # Content first, then image
                 for line in lines:
-                    para = doc.add_paragraph(line)
-                    para.alignment = text_alignment
-                    for run in para.runs:
-                        run.font.name = font_name
-                        run.font.size = Pt(font_size)
+                    DocumentServiceV2._add_paragraph(doc, line, styles["body"])
                 
                 doc.add_paragraph()  # Space before image
                 DocumentServiceV2._add_image_to_doc(doc, image_data, DocxInches(5), DocxInches(3))
@@ -642,30 +871,18 @@ class DocumentServiceV2:
                 # Add image to image cell
                 img_para = img_cell.paragraphs[0]
                 run = img_para.add_run()
-                run.add_picture(image_data, width=DocxInches(2.8))
+                run.add_picture(image_service.render_for_slot(image_data, DocxInches(2.8)), width=DocxInches(2.8))
                 
                 # Add text to text cell
                 text_cell.text = ''  # Clear default text
                 for line in lines:
-                    para = text_cell.add_paragraph(line)
-                    para.alignment = text_alignment
-                    for run in para.runs:
-                        run.font.name = font_name
-                        run.font.size = Pt(font_size)
+                    DocumentServiceV2._add_paragraph(text_cell, line, styles["body"])
             
             else:
                 # No image or image failed - just add text
                 for line in lines:
-                    para = doc.add_paragraph(line)
-                    para.alignment = text_alignment
-                    for run in para.runs:
-                        run.font.name = font_name
-                        run.font.size = Pt(font_size)
+                    DocumentServiceV2._add_paragraph(doc, line, styles["body"])
             
             doc.add_paragraph()  # Empty line between sections
         
-        # Save to BytesIO
-        file_stream = BytesIO()
-        doc.save(file_stream)
-        file_stream.seek(0)
-        return file_stream
+        return DocumentServiceV2._save(doc, output)
@@ -0,0 +1,122 @@
+"""
+Disk cache for rendered exports.
+Each entry is a finished .pptx/.docx stored under the content hash of everything that
+affects the output (see DocumentServiceV2.export_etag), so an unchanged project is served
+with one file read. Files not downloaded for the TTL are dropped, then least recently
+used ones until the directory fits the byte budget.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+EXPORT_CACHE_ENABLED = os.getenv("EXPORT_CACHE_ENABLED", "true").lower() == "true"
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", "export_cache")
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_MB", "500")) * 1024 * 1024
+EXPORT_CACHE_TTL_SECONDS = int(os.getenv("EXPORT_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+class ExportCache:
+    """Content hash -> rendered document file, with a byte budget, TTL and LRU eviction."""
+    
+    def __init__(self, directory: str = EXPORT_CACHE_DIR, max_bytes: int = EXPORT_CACHE_MAX_BYTES,
+                 ttl: int = EXPORT_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def get(self, key: str, extension: str) -> Optional[str]:
+        """
+        Path of the cached file, or None. A hit refreshes the file's last access time;
+        a file unused for the TTL is removed and counts as a miss.
+        """
+        path = self.path(key, extension)
+        with self._lock:
+            try:
+                # mtime doubles as last access time for TTL and LRU
+                if os.stat(path).st_mtime < time.time() - self.ttl:
+                    os.remove(path)
+                    self.evictions += 1
+                    self.misses += 1
+                    return None
+                os.utime(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return path
+    
+    def path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+    
+    @contextmanager
+    def writer(self, key: str, extension: str):
+        """File to render a document into; it becomes the cached entry when the block succeeds."""
+        path = self.path(key, extension)
+        # Write then rename so concurrent downloads never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                yield f
+            with self._lock:
+                os.replace(tmp_path, path)
+                self._evict(keep=path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def _entries(self) -> list:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+    
+    def _evict(self, keep: str = None):
+        """Drop files unused for the TTL, then the least recently used until under budget."""
+        now = time.time()
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if path == keep or (mtime >= now - self.ttl and total <= self.max_bytes):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+    
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+def create_export_cache_from_env() -> Optional[ExportCache]:
+    if not EXPORT_CACHE_ENABLED:
+        print("Export cache: disabled")
+        return None
+    try:
+        cache = ExportCache()
+        print(f"Export cache: {EXPORT_CACHE_DIR} ({EXPORT_CACHE_MAX_BYTES // (1024 * 1024)} MB)")
+        return cache
+    except Exception as e:
+        print(f"✗ Export cache unavailable: {e}")
+        return None
+
+export_cache = create_export_cache_from_env()
@@ -1,8 +1,18 @@
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import os
 from dotenv import load_dotenv
-import requests
+import httpx
+import asyncio
+import weakref
+import json
+import time
+import re
 from pathlib import Path
+from llm_cache import create_cache_from_env
+from circuit_breaker import CircuitBreaker
+from rate_limiter import create_limiters_from_env, estimate_tokens, RATE_LIMIT_COMPLETION_ESTIMATE
+from content_edits import split_blocks, join_blocks, preview_block, parse_edits, apply_edits
 
 # Load .env from backend directory
 env_path = Path(__file__).parent / '.env'
@@ -11,10 +21,61 @@ load_dotenv(env_path)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
+# Maximum number of sections generated at the same time for one request
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+
+# Outbound LLM connection settings (shared keep-alive pools, one per provider)
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_CONNECT_TIMEOUT_SECONDS", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+# Hedged requests: after the primary's latency percentile, also ask the secondary provider
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+LLM_HEDGE_MAX_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MAX_DELAY_SECONDS", "5"))
+LLM_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SECONDS", "2"))
+
+# Batched generation: several sections per prompt instead of one prompt per section
+LLM_BATCHED_GENERATION = os.getenv("LLM_BATCHED_GENERATION", "false").lower() == "true"
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", "6"))
+LLM_MAX_OUTPUT_TOKENS = 8000
+
+BATCH_SECTION_MARKER = re.compile(r"^\s*=+\s*SECTION\s+(\d+)\s*=+\s*$", re.IGNORECASE | re.MULTILINE)
+
 # Configure Gemini
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
 
+class _AsyncProviderPool:
+    """Async HTTP client, Gemini model and per-provider connection caps bound to one event loop."""
+    
+    def __init__(self, gemini_model_name: str = None):
+        self.groq_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS
+            )
+        )
+        # The Gemini SDK manages its own transport, so cap in-flight calls instead
+        self.gemini_slots = asyncio.Semaphore(LLM_MAX_CONNECTIONS)
+        self.gemini_model = None
+        if gemini_model_name:
+            # The SDK's default async client is one gRPC channel per process, bound to the first
+            # event loop that used it; give every loop its own channel so calls from a second
+            # loop (e.g. a background job) neither fail nor break the first one
+            self.gemini_model = genai.GenerativeModel(gemini_model_name)
+            self.gemini_model._async_client = glm.GenerativeServiceAsyncClient(
+                client_options={"api_key": GEMINI_API_KEY}
+            )
+    
+    async def aclose(self):
+        await self.groq_client.aclose()
+        if self.gemini_model:
+            await self.gemini_model._async_client.transport.close()
+
 class GeminiService:
     def __init__(self):
         # Initialize Gemini with correct model name
@@ -37,88 +98,406 @@ class GeminiService:
         
         self.groq_api_key = GROQ_API_KEY
         self.groq_url = "https://api.groq.com/openai/v1/chat/completions"
+        self.groq_model = "llama-3.1-8b-instant"  # Faster, more reliable
         # Try Groq first (faster), fallback to Gemini
         self.primary_provider = "groq" if GROQ_API_KEY else "gemini"
         print(f"Primary AI provider: {self.primary_provider}")
+        
+        # Async pools are tied to the event loop that created them
+        self._async_pools = weakref.WeakKeyDictionary()
+        
+        # Prompt-hash keyed response cache for generation and templates
+        self.cache = create_cache_from_env()
+        
+        # Per-provider health tracking for fallback routing
+        self.breakers = {
+            "groq": CircuitBreaker("groq"),
+            "gemini": CircuitBreaker("gemini")
+        }
+        
+        # Outbound requests/min and tokens/min budgets, queued fairly per user
+        self.rate_limiters = create_limiters_from_env()
+        
+        # Hedged request counters
+        self.hedge_stats = {"requests": 0, "hedged": 0, "secondary_wins": 0}
+        
+        # Refinement prompt sizes; full_prompt_tokens is what compact calls would have sent in full
+        # mode (0 for a compact call that fell back, since the full prompt was sent anyway)
+        self.refine_stats = {
+            "full": {"calls": 0, "prompt_tokens": 0},
+            "compact": {"calls": 0, "prompt_tokens": 0, "full_prompt_tokens": 0, "fallbacks": 0}
+        }
+    
+    def _groq_headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.groq_api_key}",
+            "Content-Type": "application/json"
+        }
+    
+    def _groq_payload(self, prompt: str, max_tokens: int = 2000) -> dict:
+        return {
+            "model": self.groq_model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.7,
+            "max_tokens": max_tokens
+        }
     
-    def _call_groq(self, prompt: str) -> str:
-        """Call Groq API"""
+    def _async_pool(self) -> _AsyncProviderPool:
+        """Return the async provider pool for the running event loop."""
+        loop = asyncio.get_running_loop()
+        pool = self._async_pools.get(loop)
+        if pool is None:
+            pool = _AsyncProviderPool(self.gemini_model.model_name if self.gemini_model else None)
+            self._async_pools[loop] = pool
+        return pool
+    
+    async def aclose(self):
+        """Close the async connection pool of the running event loop."""
+        pool = self._async_pools.pop(asyncio.get_running_loop(), None)
+        if pool:
+            await pool.aclose()
+    
+    def _reserved_tokens(self, prompt: str) -> int:
+        """Tokens reserved from a provider's budget before a call is made."""
+        return estimate_tokens(prompt) + RATE_LIMIT_COMPLETION_ESTIMATE
+    
+    async def _aread_groq_response(self, response, prompt: str) -> str:
+        """Extract the completion, feeding 429s and reported usage back to the rate limiter."""
+        limiter = self.rate_limiters["groq"]
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get("retry-after", "10"))
+            except ValueError:
+                retry_after = 10.0
+            await limiter.apenalize(retry_after)
+        response.raise_for_status()
+        data = response.json()
+        await limiter.asettle(self._reserved_tokens(prompt), data.get("usage", {}).get("total_tokens", 0))
+        return data["choices"][0]["message"]["content"]
+    
+    async def _acall_groq(self, prompt: str, max_tokens: int = 2000) -> str:
+        """Call Groq API without blocking the event loop"""
         if not self.groq_api_key:
             print("✗ Groq API key not found")
             return None
         try:
-            headers = {
-                "Authorization": f"Bearer {self.groq_api_key}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "model": "llama-3.1-8b-instant",  # Faster, more reliable
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.7,
-                "max_tokens": 2000
-            }
-            response = requests.post(self.groq_url, headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            result = response.json()["choices"][0]["message"]["content"]
+            response = await self._async_pool().groq_client.post(
+                self.groq_url,
+                headers=self._groq_headers(),
+                json=self._groq_payload(prompt, max_tokens)
+            )
+            result = await self._aread_groq_response(response, prompt)
             print(f"✓ Groq API success ({len(result)} chars)")
             return result
         except Exception as e:
             print(f"✗ Groq API error: {str(e)}")
-            if hasattr(e, 'response') and e.response is not None:
+            if isinstance(e, httpx.HTTPStatusError):
                 print(f"  Response: {e.response.text}")
             return None
     
-    def _call_gemini(self, prompt: str) -> str:
-        """Call Gemini API"""
+    async def _acall_gemini(self, prompt: str, max_tokens: int = None) -> str:
+        """Call Gemini API without blocking the event loop"""
         try:
             if not self.gemini_model:
                 print("✗ Gemini model not initialized")
                 return None
-            response = self.gemini_model.generate_content(prompt)
+            generation_config = {"max_output_tokens": max_tokens} if max_tokens else None
+            pool = self._async_pool()
+            async with pool.gemini_slots:
+                response = await asyncio.wait_for(
+                    pool.gemini_model.generate_content_async(prompt, generation_config=generation_config),
+                    timeout=LLM_TIMEOUT_SECONDS
+                )
             result = response.text
             print(f"✓ Gemini API success ({len(result)} chars)")
             return result
         except Exception as e:
-            print(f"✗ Gemini API error: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            print(f"✗ Gemini API error: {str(e) or type(e).__name__}")
             return None
     
-    def _generate_with_fallback(self, prompt: str) -> str:
-        """Try primary provider first, fallback to secondary"""
+    def _is_configured(self, provider: str) -> bool:
+        if provider == "groq":
+            return bool(self.groq_api_key)
+        return self.gemini_model is not None
+    
+    def _provider_order(self) -> list:
+        """Configured providers in the order they should be tried, healthy ones first."""
         if self.primary_provider == "groq":
-            result = self._call_groq(prompt)
-            if result:
-                return result
-            # Fallback to Gemini
-            result = self._call_gemini(prompt)
-            if result:
-                return result
+            preferred = ["groq", "gemini"]
         else:
-            result = self._call_gemini(prompt)
-            if result:
-                return result
-            # Fallback to Groq
-            result = self._call_groq(prompt)
+            preferred = ["gemini", "groq"]
+        configured = [provider for provider in preferred if self._is_configured(provider)]
+        # Providers with an open circuit move behind healthy ones (stable sort keeps preference)
+        return sorted(configured, key=lambda provider: self.breakers[provider].state == CircuitBreaker.OPEN)
+    
+    async def _acall_provider(self, provider: str, prompt: str, admitted: asyncio.Event = None, **options) -> str:
+        """Call one provider through its circuit breaker, recording outcome and latency.
+        admitted, if given, is set once the rate limiter lets the call go out."""
+        breaker = self.breakers[provider]
+        if not breaker.allow_request():
+            print(f"ℹ Skipping {provider}: circuit {breaker.state}")
+            return None
+        calls = {"groq": self._acall_groq, "gemini": self._acall_gemini}
+        started = None
+        try:
+            # Waiting for rate limit budget is not counted as provider latency
+            if not await self.rate_limiters[provider].aacquire(self._reserved_tokens(prompt)):
+                breaker.release()
+                return None
+            started = time.monotonic()
+            if admitted:
+                admitted.set()
+            result = await calls[provider](prompt, **options)
+        except asyncio.CancelledError:
+            # A cancelled call says nothing about provider health, but how long it had
+            # already run is still a latency sample (e.g. the slow side of a hedge)
+            breaker.release(time.monotonic() - started if started is not None else None)
+            raise
+        latency = time.monotonic() - started
+        if result:
+            breaker.record_success(latency)
+        else:
+            breaker.record_failure(latency)
+        return result
+    
+    async def _agenerate_with_fallback(self, prompt: str, **options) -> str:
+        """Try the healthiest preferred provider first, fallback to the next"""
+        return await self._agenerate_with_fallback_from(self._provider_order(), prompt, **options)
+    
+    async def _agenerate_with_fallback_from(self, providers: list, prompt: str, **options) -> str:
+        for provider in providers:
+            result = await self._acall_provider(provider, prompt, **options)
             if result:
                 return result
         
         return "Error: Unable to generate content. Please check your API keys."
     
-    def generate_content(self, section_title: str, main_topic: str, document_type: str, has_image: bool = True) -> str:
-        """Generate content for a specific section or slide with strict word limits."""
+    def _hedge_delay(self, provider: str) -> float:
+        """Seconds to wait for a provider before hedging, from its observed latency percentile."""
+        observed = self.breakers[provider].latency_percentile(LLM_HEDGE_PERCENTILE)
+        if observed is None:
+            return LLM_HEDGE_DEFAULT_DELAY_SECONDS
+        return min(max(observed, LLM_HEDGE_MIN_DELAY_SECONDS), LLM_HEDGE_MAX_DELAY_SECONDS)
+    
+    async def _agenerate_hedged(self, prompt: str) -> str:
+        """Send the prompt to the primary provider and, if it is slower than usual, to the
+        secondary as well; return the first successful answer and cancel the other call."""
+        order = self._provider_order()
+        if len(order) < 2:
+            return await self._agenerate_with_fallback(prompt)
+        
+        primary, secondary = order[0], order[1]
+        self.hedge_stats["requests"] += 1
+        admitted = asyncio.Event()
+        primary_task = asyncio.create_task(self._acall_provider(primary, prompt, admitted=admitted))
+        tasks = {primary_task}
+        try:
+            # The hedge clock starts once the primary's rate limiter admits the call; a call
+            # queued on its own budget is not slow and hedging it would spend the secondary's
+            admission = asyncio.create_task(admitted.wait())
+            try:
+                await asyncio.wait({primary_task, admission}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                admission.cancel()
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay(primary))
+            if done:
+                result = primary_task.result()
+                if result:
+                    return result
+                # Primary failed quickly: ordinary fallback, nothing to race against
+                return await self._agenerate_with_fallback_from(order[1:], prompt)
+            
+            print(f"ℹ {primary.title()} slower than p{LLM_HEDGE_PERCENTILE:.0f}, hedging with {secondary}")
+            self.hedge_stats["hedged"] += 1
+            secondary_task = asyncio.create_task(self._acall_provider(secondary, prompt))
+            tasks.add(secondary_task)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result:
+                        if task is secondary_task:
+                            self.hedge_stats["secondary_wins"] += 1
+                        return result
+            
+            return "Error: Unable to generate content. Please check your API keys."
+        finally:
+            # Cancel the losing (or abandoned) call so it releases its connection
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+    
+    def _hedge_metrics(self) -> dict:
+        requests_count = self.hedge_stats["requests"]
+        hedged = self.hedge_stats["hedged"]
+        return dict(
+            self.hedge_stats,
+            enabled_by_default=LLM_HEDGING_ENABLED,
+            hedge_rate=round(hedged / requests_count, 3) if requests_count else 0.0,
+            win_rate=round(self.hedge_stats["secondary_wins"] / hedged, 3) if hedged else 0.0,
+            delay_seconds={provider: round(self._hedge_delay(provider), 3) for provider in self.breakers}
+        )
+    
+    def _refine_metrics(self) -> dict:
+        compact = self.refine_stats["compact"]
+        saved = compact["full_prompt_tokens"] - compact["prompt_tokens"]
+        return dict(
+            self.refine_stats,
+            compact_tokens_saved=saved,
+            compact_savings_rate=round(saved / compact["full_prompt_tokens"], 3) if compact["full_prompt_tokens"] else 0.0
+        )
+    
+    async def _astream_groq(self, prompt: str):
+        """Stream Groq completion tokens as they arrive"""
+        if not self.groq_api_key:
+            print("✗ Groq API key not found")
+            return
+        payload = self._groq_payload(prompt)
+        payload["stream"] = True
+        async with self._async_pool().groq_client.stream(
+            "POST", self.groq_url, headers=self._groq_headers(), json=payload
+        ) as response:
+            if response.status_code == 429:
+                await self.rate_limiters["groq"].apenalize(float(response.headers.get("retry-after", "10")))
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # OpenAI-compatible SSE: "data: {...}" lines, terminated by "data: [DONE]"
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    
+    async def _astream_gemini(self, prompt: str):
+        """Stream Gemini completion chunks as they arrive"""
+        if not self.gemini_model:
+            print("✗ Gemini model not initialized")
+            return
+        pool = self._async_pool()
+        async with pool.gemini_slots:
+            response = await asyncio.wait_for(
+                pool.gemini_model.generate_content_async(prompt, stream=True),
+                timeout=LLM_TIMEOUT_SECONDS
+            )
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+    
+    async def _astream_with_fallback(self, prompt: str):
+        """Stream from the first provider that produces output.
+        
+        Falling back is only possible before the first token has been sent;
+        a provider failing mid-stream ends the stream with what was produced.
+        """
+        streams = {"groq": self._astream_groq, "gemini": self._astream_gemini}
+        for provider in self._provider_order():
+            breaker = self.breakers[provider]
+            if not breaker.allow_request():
+                print(f"ℹ Skipping {provider}: circuit {breaker.state}")
+                continue
+            try:
+                granted = await self.rate_limiters[provider].aacquire(self._reserved_tokens(prompt))
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            if not granted:
+                breaker.release()
+                continue
+            produced = False
+            completed = None  # None: the consumer stopped reading before the stream ended
+            started = time.monotonic()
+            try:
+                async for text in streams[provider](prompt):
+                    produced = True
+                    yield text
+                completed = produced
+            except Exception as e:
+                completed = False
+                print(f"✗ {provider.title()} stream error: {str(e) or type(e).__name__}")
+            finally:
+                latency = time.monotonic() - started
+                if completed is None:
+                    breaker.release()
+                elif completed:
+                    breaker.record_success(latency)
+                else:
+                    breaker.record_failure(latency)
+            if completed:
+                print(f"✓ {provider.title()} stream complete")
+                return
+            if produced:
+                return
+        
+        yield "Error: Unable to generate content. Please check your API keys."
+    
+    def _cache_key(self, namespace: str, prompt: str) -> str:
+        """Cache key for a prompt under the current model configuration."""
+        gemini_name = getattr(self.gemini_model, "model_name", None)
+        return self.cache.make_key(
+            namespace, prompt,
+            groq_model=self.groq_model, gemini_model=gemini_name, temperature=0.7
+        )
+    
+    def _is_usable(self, result: str) -> bool:
+        return bool(result) and not result.startswith("Error")
+    
+    async def _agenerate_cached(self, namespace: str, prompt: str, use_cache: bool = True) -> str:
+        """Serve a prompt from the cache, calling the providers on a miss or bypass."""
+        key = self._cache_key(namespace, prompt)
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        result = await self._agenerate_with_fallback(prompt)
+        if self._is_usable(result):
+            self.cache.set(key, result)
+        return result
+    
+    async def _astream_cached(self, namespace: str, prompt: str, use_cache: bool = True):
+        """Stream a prompt, replaying a cached response in a single chunk on a hit"""
+        key = self._cache_key(namespace, prompt)
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+        chunks = []
+        async for text in self._astream_with_fallback(prompt):
+            chunks.append(text)
+            yield text
+        result = "".join(chunks)
+        if self._is_usable(result):
+            self.cache.set(key, result)
+    
+    def get_metrics(self) -> dict:
+        """Counters for the AI provider layer."""
+        return {
+            "cache": self.cache.stats(),
+            "hedging": self._hedge_metrics(),
+            "refine": self._refine_metrics(),
+            "rate_limits": {provider: limiter.stats() for provider, limiter in self.rate_limiters.items()},
+            "providers": {
+                provider: dict(breaker.stats(), configured=self._is_configured(provider))
+                for provider, breaker in self.breakers.items()
+            }
+        }
+    
+    def _slide_limits(self, has_image: bool) -> tuple:
+        """Strict word limits for a slide based on image presence."""
+        if has_image:
+            return "60-80 words total", "4-5 bullet points", "12-16 words per point"
+        return "100-120 words total", "6-7 bullet points", "15-18 words per point"
+    
+    def _build_content_prompt(self, section_title: str, main_topic: str, document_type: str, has_image: bool = True) -> str:
+        """Build the generation prompt for a section or slide with strict word limits."""
         if document_type == "pptx":
-            # Strict word limits based on image presence
-            if has_image:
-                word_limit = "60-80 words total"
-                bullet_count = "4-5 bullet points"
-                words_per_bullet = "12-16 words per point"
-            else:
-                word_limit = "100-120 words total"
-                bullet_count = "6-7 bullet points"
-                words_per_bullet = "15-18 words per point"
+            word_limit, bullet_count, words_per_bullet = self._slide_limits(has_image)
             
-            prompt = f"""Generate content for a PowerPoint slide about "{section_title}" in the context of "{main_topic}".
+            return f"""Generate content for a PowerPoint slide about "{section_title}" in the context of "{main_topic}".
 
 CRITICAL REQUIREMENTS:
 - Total content: {word_limit}
@@ -136,8 +515,8 @@ Format example:
 - Third relevant detail concisely
 
 Generate ONLY the bullet points, nothing else."""
-        else:
-            prompt = f"""Generate detailed content for a Word document section with the following details:
+        
+        return f"""Generate detailed content for a Word document section with the following details:
 Main Topic: {main_topic}
 Section Title: {section_title}
 
@@ -150,26 +529,273 @@ CRITICAL REQUIREMENTS:
 - Just the body text
 
 Generate ONLY the content paragraphs, nothing else."""
+    
+    async def agenerate_content(self, section_title: str, main_topic: str, document_type: str, has_image: bool = True,
+                                use_cache: bool = True) -> str:
+        """Generate content for a specific section or slide with strict word limits."""
+        prompt = self._build_content_prompt(section_title, main_topic, document_type, has_image)
+        return await self._agenerate_cached("content", prompt, use_cache)
+    
+    async def agenerate_contents(self, section_titles: list, main_topic: str, document_type: str,
+                                 has_image: bool = True, max_concurrency: int = None,
+                                 use_cache: bool = True) -> list:
+        """Generate content for several sections concurrently, preserving input order."""
+        if not section_titles:
+            return []
+        
+        limit = max(1, min(max_concurrency or GENERATION_CONCURRENCY, len(section_titles)))
+        print(f"Generating {len(section_titles)} sections (concurrency: {limit})")
+        slots = asyncio.Semaphore(limit)
+        
+        async def generate_one(title):
+            async with slots:
+                return await self.agenerate_content(title, main_topic, document_type, has_image, use_cache)
+        
+        return await asyncio.gather(*(generate_one(title) for title in section_titles))
+    
+    def astream_content(self, section_title: str, main_topic: str, document_type: str, has_image: bool = True,
+                        use_cache: bool = True):
+        """Stream generated content for a section as text chunks."""
+        prompt = self._build_content_prompt(section_title, main_topic, document_type, has_image)
+        return self._astream_cached("content", prompt, use_cache)
+    
+    def _build_batch_prompt(self, section_titles: list, main_topic: str, document_type: str, has_image: bool = True) -> str:
+        """One prompt asking for the content of several sections, delimited by section markers."""
+        numbered = "\n".join(f"{i}. {title}" for i, title in enumerate(section_titles, 1))
+        if document_type == "pptx":
+            word_limit, bullet_count, words_per_bullet = self._slide_limits(has_image)
+            unit = "slide"
+            requirements = f"""- Total content per slide: {word_limit}
+- Number of points per slide: {bullet_count}
+- Length per point: {words_per_bullet}
+- Each bullet point must be ONE sentence only
+- Use simple, clear language
+- NO markdown formatting (no **, *, etc.)
+- NO headers like "Slide Title:" or "Key Points:"
+- Start each line with a simple dash (-)"""
+        else:
+            unit = "section"
+            requirements = """- DO NOT repeat the section title in the content
+- Provide well-structured, professional content with 2-3 paragraphs per section
+- Make it informative and business-appropriate
+- NO headers or titles in the content
+- Just the body text"""
+        
+        return f"""Generate content for {len(section_titles)} {'PowerPoint slides' if document_type == 'pptx' else 'Word document sections'} in the context of "{main_topic}".
+
+{unit.title()}s:
+{numbered}
+
+CRITICAL REQUIREMENTS:
+{requirements}
+
+OUTPUT FORMAT:
+Write each {unit} under its own marker line, in the same order, with nothing before the first marker:
+=== SECTION 1 ===
+(content for {unit} 1)
+=== SECTION 2 ===
+(content for {unit} 2)
+
+Generate ONLY the markers and the content, nothing else."""
+    
+    def _parse_batch(self, result: str, count: int) -> dict:
+        """Split a batched response into {index: content} (0-based), skipping empty or unknown parts."""
+        parsed = {}
+        if not self._is_usable(result):
+            return parsed
+        markers = list(BATCH_SECTION_MARKER.finditer(result))
+        for i, marker in enumerate(markers):
+            index = int(marker.group(1)) - 1
+            end = markers[i + 1].start() if i + 1 < len(markers) else len(result)
+            content = result[marker.end():end].strip()
+            if 0 <= index < count and content and index not in parsed:
+                parsed[index] = content
+        return parsed
+    
+    async def agenerate_contents_batched(self, section_titles: list, main_topic: str, document_type: str,
+                                         has_image: bool = True, batch_size: int = None,
+                                         use_cache: bool = True) -> list:
+        """Generate several sections with a few combined prompts, preserving input order.
+        
+        Each batched answer is split back into sections and stored under the same cache key a
+        single-section call would use; sections that cannot be parsed fall back to their own call.
+        """
+        if not section_titles:
+            return []
+        
+        results = [None] * len(section_titles)
+        keys = [
+            self._cache_key("content", self._build_content_prompt(title, main_topic, document_type, has_image))
+            for title in section_titles
+        ]
+        if use_cache:
+            for i, key in enumerate(keys):
+                results[i] = self.cache.get(key)
+        
+        missing = [i for i, result in enumerate(results) if result is None]
+        size = max(1, batch_size or LLM_BATCH_SIZE)
+        chunks = [missing[start:start + size] for start in range(0, len(missing), size)]
+        per_section_tokens = 400 if document_type == "pptx" else 700
+        print(f"Batched generation: {len(missing)} of {len(section_titles)} sections in {len(chunks)} prompts")
+        
+        slots = asyncio.Semaphore(GENERATION_CONCURRENCY)
         
-        return self._generate_with_fallback(prompt)
+        async def generate_chunk(indices):
+            async with slots:
+                prompt = self._build_batch_prompt(
+                    [section_titles[i] for i in indices], main_topic, document_type, has_image
+                )
+                result = await self._agenerate_with_fallback(
+                    prompt, max_tokens=min(LLM_MAX_OUTPUT_TOKENS, per_section_tokens * len(indices))
+                )
+            for position, content in self._parse_batch(result, len(indices)).items():
+                index = indices[position]
+                results[index] = content
+                self.cache.set(keys[index], content)
+        
+        await asyncio.gather(*(generate_chunk(chunk) for chunk in chunks))
+        
+        # Per-section calls only for sections the batched answers did not cover
+        unparsed = [i for i, result in enumerate(results) if result is None]
+        if unparsed:
+            print(f"ℹ Batched output missing {len(unparsed)} sections, generating them individually")
+            fallbacks = await self.agenerate_contents(
+                [section_titles[i] for i in unparsed], main_topic, document_type, has_image, use_cache=False
+            )
+            for index, content in zip(unparsed, fallbacks):
+                results[index] = content
+        
+        return results
     
-    def refine_content(self, current_content: str, refinement_prompt: str, document_type: str) -> str:
-        """Refine existing content based on user prompt."""
-        prompt = f"""Current content:
+    def _build_refine_prompt(self, current_content: str, refinement_prompt: str, document_type: str) -> str:
+        return f"""Current content:
 {current_content}
 
 User refinement request: {refinement_prompt}
 
-Please modify the content according to the user's request. 
+Please modify the content according to the user's request.
 Maintain the same format and style ({'bullet points for slides' if document_type == 'pptx' else 'paragraphs for document'})."""
+    
+    def _build_compact_refine_prompt(self, blocks: list, targets: set, refinement_prompt: str, document_type: str) -> str:
+        """Numbered blocks with only the targeted ones in full, answered with block edits."""
+        unit = "bullet point" if document_type == "pptx" else "paragraph"
+        numbered = []
+        for index, block in enumerate(blocks, 1):
+            if not targets or index in targets:
+                numbered.append(f"[{index}]\n{block}")
+            else:
+                numbered.append(f"[{index}] (preview) {preview_block(block)}")
+        if targets:
+            scope = f"Only change {unit}s {', '.join(str(i) for i in sorted(targets))}; the others are shown as previews for context."
+        else:
+            scope = f"Change only the {unit}s the request requires."
         
-        return self._generate_with_fallback(prompt)
+        return f"""Current content, as numbered {unit}s:
+{chr(10).join(numbered)}
+
+User refinement request: {refinement_prompt}
+
+{scope}
+Return ONLY your edits, in this format:
+[n]
+<the complete new text of {unit} n>
+
+To delete {unit} n, write [n] followed by a line containing only DELETE.
+To add a new {unit} after {unit} n, write [+n] followed by its text ([+0] adds it at the start).
+{unit.capitalize()}s you do not mention stay unchanged.
+Maintain the same format and style ({'bullet points for slides' if document_type == 'pptx' else 'paragraphs for document'})."""
     
-    def generate_template(self, main_topic: str, document_type: str, num_sections: int = None) -> list:
-        """Generate section titles or slide titles based on main topic."""
+    def _record_refine(self, mode: str, prompt_tokens: int, full_prompt_tokens: int = 0):
+        stats = self.refine_stats[mode]
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        if mode == "compact":
+            stats["full_prompt_tokens"] += full_prompt_tokens
+    
+    async def _arefine_call(self, prompt: str, hedge: bool = None) -> str:
+        if hedge is None:
+            hedge = LLM_HEDGING_ENABLED
+        if hedge:
+            return await self._agenerate_hedged(prompt)
+        return await self._agenerate_with_fallback(prompt)
+    
+    async def arefine_section(self, current_content: str, refinement_prompt: str, document_type: str,
+                              target_blocks: list = None, compact: bool = None, hedge: bool = None) -> dict:
+        """
+        Refine content and report how it was done.
+        target_blocks are 0-based paragraph/bullet indices to rewrite. compact=None uses compact
+        mode only when blocks are targeted: without targets every block is sent in full, so the
+        compact prompt is larger than the full one and saves nothing.
+        Returns {"content", "mode", "prompt_tokens", "full_prompt_tokens"} (token counts estimated).
+        """
+        full_prompt = self._build_refine_prompt(current_content, refinement_prompt, document_type)
+        full_tokens = estimate_tokens(full_prompt)
+        blocks, separator = split_blocks(current_content)
+        
+        targets = set()
+        for index in target_blocks or []:
+            if not 0 <= index < len(blocks):
+                raise ValueError(f"Block {index} is out of range (content has {len(blocks)} blocks)")
+            targets.add(index + 1)
+        
+        if compact is None:
+            compact = bool(targets)
+        
+        if compact and blocks:
+            prompt = self._build_compact_refine_prompt(blocks, targets, refinement_prompt, document_type)
+            prompt_tokens = estimate_tokens(prompt)
+            response = await self._arefine_call(prompt, hedge)
+            
+            applied = 0
+            if self._is_usable(response):
+                new_blocks, applied = apply_edits(blocks, parse_edits(response), targets or None)
+                if not applied and len(targets) == 1 and len(split_blocks(response)[0]) == 1:
+                    # A single targeted block answered with one unmarked block is its replacement;
+                    # an unmarked multi-block answer is a full rewrite and goes to the fallback
+                    new_blocks = list(blocks)
+                    new_blocks[next(iter(targets)) - 1] = response.strip()
+                    applied = 1
+            if applied:
+                self._record_refine("compact", prompt_tokens, full_tokens)
+                return {
+                    "content": join_blocks(new_blocks, separator),
+                    "mode": "compact",
+                    "prompt_tokens": prompt_tokens,
+                    "full_prompt_tokens": full_tokens
+                }
+            
+            print("ℹ Compact refinement returned no usable edits, refining the full content")
+            self._record_refine("compact", prompt_tokens)
+            self.refine_stats["compact"]["fallbacks"] += 1
+            spent_tokens = prompt_tokens
+        else:
+            spent_tokens = 0
+        
+        self._record_refine("full", full_tokens)
+        content = await self._arefine_call(full_prompt, hedge)
+        # A failed compact attempt is reported with the full call, not as a saving
+        return {
+            "content": content,
+            "mode": "full",
+            "prompt_tokens": spent_tokens + full_tokens,
+            "full_prompt_tokens": full_tokens
+        }
+    
+    async def arefine_content(self, current_content: str, refinement_prompt: str, document_type: str,
+                              hedge: bool = None) -> str:
+        """Refine existing content based on user prompt. hedge=None follows LLM_HEDGING_ENABLED."""
+        result = await self.arefine_section(current_content, refinement_prompt, document_type, compact=False, hedge=hedge)
+        return result["content"]
+    
+    def astream_refine(self, current_content: str, refinement_prompt: str, document_type: str):
+        """Stream refined content as text chunks."""
+        prompt = self._build_refine_prompt(current_content, refinement_prompt, document_type)
+        self._record_refine("full", estimate_tokens(prompt))
+        return self._astream_with_fallback(prompt)
+    
+    def _build_template_prompt(self, main_topic: str, document_type: str, num: int) -> str:
         if document_type == "pptx":
-            num = num_sections or 8
-            prompt = f"""Create {num} PowerPoint slide titles with descriptions for: {main_topic}
+            return f"""Create {num} PowerPoint slide titles with descriptions for: {main_topic}
 
 Use this exact format for each slide (no extra text):
 
@@ -180,9 +806,8 @@ TITLE: Current Applications
 DESC: Real-world examples of AI in various industries
 
 Now create {num} slides following this format exactly. Start immediately with "TITLE:" - no introduction or explanation."""
-        else:
-            num = num_sections or 5
-            prompt = f"""Create {num} Word document section headings with descriptions for: {main_topic}
+        
+        return f"""Create {num} Word document section headings with descriptions for: {main_topic}
 
 Use this exact format for each section (no extra text):
 
@@ -193,9 +818,9 @@ TITLE: Methodology
 DESC: Research approach and data collection methods
 
 Now create {num} sections following this format exactly. Start immediately with "TITLE:" - no introduction or explanation."""
-        
-        result = self._generate_with_fallback(prompt)
-        
+    
+    def _parse_template(self, result: str, num: int) -> list:
+        """Parse TITLE:/DESC: output into section templates."""
         if result and not result.startswith("Error"):
             # Parse title and description format for both pptx and docx
             sections = []
@@ -235,5 +860,18 @@ Now create {num} sections following this format exactly. Start immediately with
         
         # Fallback
         return [{"title": f"Section {i+1}", "description": ""} for i in range(num)]
+    
+    def _template_count(self, document_type: str, num_sections: int = None) -> int:
+        if document_type == "pptx":
+            return num_sections or 8
+        return num_sections or 5
+    
+    async def agenerate_template(self, main_topic: str, document_type: str, num_sections: int = None,
+                                 use_cache: bool = True) -> list:
+        """Generate section titles or slide titles based on main topic."""
+        num = self._template_count(document_type, num_sections)
+        prompt = self._build_template_prompt(main_topic, document_type, num)
+        result = await self._agenerate_cached("template", prompt, use_cache)
+        return self._parse_template(result, num)
 
 gemini_service = GeminiService()
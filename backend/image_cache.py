@@ -0,0 +1,170 @@
+"""
+Disk cache for slide images.
+Entries map a normalized image query to the final encoded image bytes. Bytes are stored
+content-addressed (one file per distinct image) and indexed in a small SQLite file that
+tracks size, expiry and last access for TTL and least-recently-used eviction.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "200")) * 1024 * 1024
+IMAGE_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+# Placeholders are cached too so offline exports skip the network, but retried sooner
+IMAGE_CACHE_PLACEHOLDER_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_PLACEHOLDER_TTL_SECONDS", str(60 * 60)))
+
+def normalize_query(*parts: str) -> str:
+    """Lowercase, strip punctuation and collapse whitespace so equivalent queries share a key."""
+    text = " ".join(part for part in parts if part).lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+class ImageCache:
+    """Query -> image bytes cache with a byte budget, TTL and LRU eviction."""
+    
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 ttl: int = IMAGE_CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.index_path = os.path.join(directory, "index.db")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, blob TEXT NOT NULL, size INTEGER NOT NULL, "
+                "source TEXT, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries (last_access)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_blob ON entries (blob)")
+    
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def make_key(query: str, variant: str = "") -> str:
+        return hashlib.sha256(f"{query}|{variant}".encode("utf-8")).hexdigest()
+    
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.directory, "blobs", blob[:2], blob)
+    
+    def _remove_blob_if_unused(self, conn, blob: str):
+        if conn.execute("SELECT 1 FROM entries WHERE blob = ? LIMIT 1", (blob,)).fetchone() is None:
+            try:
+                os.remove(self._blob_path(blob))
+            except FileNotFoundError:
+                pass
+    
+    def _delete_entry(self, conn, key: str, blob: str):
+        conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._remove_blob_if_unused(conn, blob)
+    
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT blob, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            data = None
+            if row is not None and row[1] >= now:
+                try:
+                    with open(self._blob_path(row[0]), "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    data = None
+            if data is None:
+                if row is not None:
+                    self._delete_entry(conn, key, row[0])
+                self.misses += 1
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return data
+    
+    def set(self, key: str, data: bytes, source: str = None, ttl: int = None):
+        if not data:
+            return
+        now = time.time()
+        blob = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(blob)
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write then rename so readers never see a partial file
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            with self._connect() as conn:
+                previous = conn.execute("SELECT blob FROM entries WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, blob, size, source, expires_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, blob, len(data), source, now + (ttl if ttl is not None else self.ttl), now)
+                )
+                if previous and previous[0] != blob:
+                    self._remove_blob_if_unused(conn, previous[0])
+                self._evict(conn, now)
+    
+    def _total_bytes(self, conn) -> int:
+        # Identical images share one blob, so count each blob once
+        row = conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT blob, MAX(size) AS size FROM entries GROUP BY blob)").fetchone()
+        return row[0]
+    
+    def _evict(self, conn, now: float):
+        """Drop expired entries, then least recently used ones until under the byte budget."""
+        for key, blob in conn.execute("SELECT key, blob FROM entries WHERE expires_at < ?", (now,)).fetchall():
+            self._delete_entry(conn, key, blob)
+            self.evictions += 1
+        total = self._total_bytes(conn)
+        if total <= self.max_bytes:
+            return
+        for key, blob in conn.execute("SELECT key, blob FROM entries ORDER BY last_access").fetchall():
+            self._delete_entry(conn, key, blob)
+            self.evictions += 1
+            total = self._total_bytes(conn)
+            if total <= self.max_bytes:
+                break
+    
+    def stats(self) -> dict:
+        with self._lock, self._connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            total = self._total_bytes(conn)
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+def create_image_cache_from_env() -> Optional[ImageCache]:
+    if not IMAGE_CACHE_ENABLED:
+        print("Image cache: disabled")
+        return None
+    try:
+        cache = ImageCache()
+        print(f"Image cache: {IMAGE_CACHE_DIR} ({IMAGE_CACHE_MAX_BYTES // (1024 * 1024)} MB)")
+        return cache
+    except Exception as e:
+        print(f"✗ Image cache unavailable: {e}")
+        return None
@@ -0,0 +1,190 @@
+"""
+Local image library for offline image lookup.
+A directory of licensed images is indexed by keywords from file names, folder names and
+optional sidecar tags (photo.jpg + photo.txt with comma separated tags, or photo.json with
+{"tags": [...], "title": "..."}). Lookups score images with TF-IDF over an inverted
+index, entirely in-process.
+
+Build or refresh the index file ahead of deployment with:
+    python image_library.py build [directory]
+"""
+import json
+import math
+import os
+import re
+import sys
+import threading
+from collections import Counter, defaultdict
+from typing import Optional
+
+IMAGE_LIBRARY_DIR = os.getenv("IMAGE_LIBRARY_DIR", "image_library")
+IMAGE_LIBRARY_MIN_SCORE = float(os.getenv("IMAGE_LIBRARY_MIN_SCORE", "0.15"))
+
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+STOP_WORDS = {
+    'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'plus', 'minus',
+    'as', 'of', 'with', 'by', 'from', 'into', 'about', 'how', 'what', 'why', 'our', 'your',
+    'img', 'image', 'photo', 'picture', 'stock', 'copy', 'final'
+}
+
+def tokenize(text: str) -> list:
+    """Lowercase keywords with stop words removed and plurals folded (panels -> panel)."""
+    # Split camelCase and any non-alphanumeric separators
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text or "").lower()
+    tokens = []
+    for word in re.split(r"[^a-z0-9]+", text):
+        if len(word) <= 2 or word in STOP_WORDS or word.isdigit():
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def _sidecar_terms(path: str) -> list:
+    base = os.path.splitext(path)[0]
+    terms = []
+    if os.path.exists(base + ".txt"):
+        with open(base + ".txt", encoding="utf-8") as f:
+            terms.extend(tokenize(f.read()))
+    if os.path.exists(base + ".json"):
+        with open(base + ".json", encoding="utf-8") as f:
+            data = json.load(f)
+        terms.extend(tokenize(" ".join(data.get("tags", []))))
+        terms.extend(tokenize(data.get("title", "")))
+    return terms
+
+class ImageLibrary:
+    """TF-IDF inverted index over a directory of images."""
+    
+    def __init__(self, directory: str = IMAGE_LIBRARY_DIR, min_score: float = IMAGE_LIBRARY_MIN_SCORE):
+        self.directory = directory
+        self.min_score = min_score
+        self.paths = []  # doc id -> path relative to directory
+        self.postings = {}  # term -> [(doc id, weight)]
+        self.idf = {}
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self.paths)
+    
+    def _scan(self) -> list:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    files.append(os.path.relpath(os.path.join(root, name), self.directory))
+        return sorted(files)
+    
+    def _signature(self, files: list) -> list:
+        """Changes whenever an image or sidecar is added, removed or edited."""
+        latest = 0.0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name != INDEX_FILE:
+                    latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+        return [len(files), latest]
+    
+    def build(self) -> dict:
+        """Index every image in the directory and return the serializable index."""
+        files = self._scan()
+        documents = []
+        for relative in files:
+            folder, name = os.path.split(relative)
+            terms = tokenize(os.path.splitext(name)[0]) + tokenize(folder.replace(os.sep, " "))
+            try:
+                terms += _sidecar_terms(os.path.join(self.directory, relative))
+            except (OSError, ValueError) as e:
+                print(f"✗ Could not read tags for {relative}: {e}")
+            documents.append(Counter(terms))
+        
+        document_frequency = Counter(term for terms in documents for term in terms)
+        idf = {term: math.log((1 + len(files)) / (1 + df)) + 1.0 for term, df in document_frequency.items()}
+        
+        postings = defaultdict(list)
+        for doc_id, terms in enumerate(documents):
+            weights = {term: (1 + math.log(count)) * idf[term] for term, count in terms.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for term, weight in weights.items():
+                postings[term].append([doc_id, round(weight / norm, 5)])
+        
+        return {
+            "version": INDEX_VERSION,
+            "signature": self._signature(files),
+            "paths": files,
+            "idf": idf,
+            "postings": postings
+        }
+    
+    def _apply(self, index: dict):
+        with self._lock:
+            self.paths = index["paths"]
+            self.idf = index["idf"]
+            self.postings = {term: [tuple(entry) for entry in entries] for term, entries in index["postings"].items()}
+    
+    def load(self, rebuild_if_stale: bool = True):
+        """Load the prebuilt index file, rebuilding (and saving) it when images changed."""
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        index = None
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") != INDEX_VERSION:
+                index = None
+            elif rebuild_if_stale and index.get("signature") != self._signature(index.get("paths", [])):
+                index = None
+            elif rebuild_if_stale and index.get("paths") != self._scan():
+                index = None
+        if index is None:
+            index = self.build()
+            try:
+                with open(index_path, "w", encoding="utf-8") as f:
+                    json.dump(index, f)
+            except OSError as e:
+                print(f"ℹ Image library index not saved ({e}), kept in memory")
+        self._apply(index)
+    
+    def search(self, query: str, limit: int = 5) -> list:
+        """Best matching images as [(score, absolute path)], highest cosine score first."""
+        terms = Counter(tokenize(query))
+        if not terms or not self.paths:
+            return []
+        with self._lock:
+            weights = {term: (1 + math.log(count)) * self.idf[term] for term, count in terms.items() if term in self.idf}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            scores = defaultdict(float)
+            for term, weight in weights.items():
+                for doc_id, doc_weight in self.postings.get(term, ()):
+                    scores[doc_id] += weight / norm * doc_weight
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            return [
+                (round(score, 4), os.path.join(self.directory, self.paths[doc_id]))
+                for doc_id, score in ranked[:limit] if score >= self.min_score
+            ]
+
+def create_image_library_from_env() -> Optional[ImageLibrary]:
+    """Load the library when IMAGE_LIBRARY_DIR exists; None otherwise."""
+    if not os.path.isdir(IMAGE_LIBRARY_DIR):
+        print("ℹ Local image library not configured (optional)")
+        return None
+    try:
+        library = ImageLibrary()
+        library.load()
+        print(f"✓ Local image library: {len(library)} images")
+        return library
+    except Exception as e:
+        print(f"✗ Local image library unavailable: {e}")
+        return None
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "build":
+        library = ImageLibrary(sys.argv[2] if len(sys.argv) > 2 else IMAGE_LIBRARY_DIR)
+        index = library.build()
+        with open(os.path.join(library.directory, INDEX_FILE), "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        print(f"✓ Indexed {len(index['paths'])} images, {len(index['idf'])} keywords")
+    else:
+        print("Usage: python image_library.py build [directory]")
@@ -1,22 +1,406 @@
 import requests
+from requests.adapters import HTTPAdapter
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageOps, ImageChops, ImageDraw, ImageFont
 import os
 import random
 import hashlib
 from dotenv import load_dotenv
 import google.generativeai as genai
 import base64
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import textwrap
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from image_cache import create_image_cache_from_env, normalize_query, IMAGE_CACHE_PLACEHOLDER_TTL_SECONDS
+from image_library import create_image_library_from_env
+from circuit_breaker import CircuitBreaker
 
 load_dotenv()
 
+# Box every fetched image is scaled to fit (aspect preserved); part of the cache key
+IMAGE_SIZE = (800, 600)
+
+# Online sources only enrich the local library; disable them on hosts without internet access
+IMAGE_NETWORK_SOURCES = os.getenv("IMAGE_NETWORK_SOURCES", "true").lower() == "true"
+
+# Images fetched at the same time while preparing one export
+IMAGE_PREFETCH_WORKERS = int(os.getenv("IMAGE_PREFETCH_WORKERS", "6"))
+
+# Source racing: query sources concurrently, higher priority ones get a head start
+IMAGE_SOURCE_RACING = os.getenv("IMAGE_SOURCE_RACING", "true").lower() == "true"
+IMAGE_RACE_HEAD_START_SECONDS = float(os.getenv("IMAGE_RACE_HEAD_START_SECONDS", "1.0"))
+IMAGE_FETCH_DEADLINE_SECONDS = float(os.getenv("IMAGE_FETCH_DEADLINE_SECONDS", "8"))
+# How long a lower priority result waits for higher priority sources still in flight
+IMAGE_RACE_GRACE_SECONDS = float(os.getenv("IMAGE_RACE_GRACE_SECONDS", "1.5"))
+
+# Online image sources: defaults per source, each overridable with IMAGE_SOURCE_<NAME>_<SETTING>.
+# Lower priority + cost is tried first; cost is in priority steps (e.g. paid API quota).
+IMAGE_SOURCE_DEFAULTS = {
+    "google": {"priority": 0, "timeout": 10, "cost": 0.5},
+    "pexels": {"priority": 1, "timeout": 8, "cost": 0},
+    "picsum": {"priority": 2, "timeout": 3, "cost": 0},
+    "pollinations": {"priority": 3, "timeout": 15, "cost": 0, "enabled": False}
+}
+# Priority steps added per second of expected latency (median latency / success rate)
+IMAGE_SOURCE_LATENCY_WEIGHT = float(os.getenv("IMAGE_SOURCE_LATENCY_WEIGHT", "1.0"))
+# Outcomes remembered for ordering, and how long a failing source is skipped
+IMAGE_SOURCE_WINDOW_SECONDS = float(os.getenv("IMAGE_SOURCE_WINDOW_SECONDS", "600"))
+IMAGE_SOURCE_OPEN_SECONDS = float(os.getenv("IMAGE_SOURCE_OPEN_SECONDS", "300"))
+LATENCY_BUCKETS_SECONDS = (0.25, 0.5, 1, 2, 4, 8, 16)
+
+# Pooled HTTP session for image downloads
+IMAGE_HTTP_POOL_SIZE = int(os.getenv("IMAGE_HTTP_POOL_SIZE", "20"))
+# Downloads larger than this are abandoned instead of being read into memory
+IMAGE_MAX_DOWNLOAD_BYTES = int(os.getenv("IMAGE_MAX_DOWNLOAD_MB", "10")) * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+BROWSER_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+# Decode limits and output encoding shared by every image source
+IMAGE_MAX_PIXELS = int(float(os.getenv("IMAGE_MAX_MEGAPIXELS", "40")) * 1000 * 1000)
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+SMALL_TARGET_PIXELS = 400 * 300
+
+# Image URLs remembered across exports to vary images between decks
+IMAGE_DEDUP_MAX_URLS = int(os.getenv("IMAGE_DEDUP_MAX_URLS", "5000"))
+
+# Pixel density images are rendered at for their slot in the document
+IMAGE_RENDER_DPI = int(os.getenv("IMAGE_RENDER_DPI", "150"))
+EMU_PER_INCH = 914400
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    if img.mode == 'RGB':
+        return img
+    if img.mode in ('RGBA', 'LA', 'P') and (img.mode != 'P' or 'transparency' in img.info):
+        # Flatten transparency onto white instead of black
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+def _resample_filter(source_size: tuple, target_size: tuple):
+    """Resampling quality by target: LANCZOS for slide-sized output, cheaper filters for thumbnails and upscaling."""
+    if target_size[0] > source_size[0] or target_size[1] > source_size[1]:
+        return Image.Resampling.BICUBIC
+    if target_size[0] * target_size[1] <= SMALL_TARGET_PIXELS:
+        return Image.Resampling.BILINEAR
+    return Image.Resampling.LANCZOS
+
+def _fit_size(source_size: tuple, box: tuple) -> tuple:
+    """Largest size with the source's aspect ratio that fits in box (never upscaled)."""
+    scale = min(box[0] / source_size[0], box[1] / source_size[1], 1.0)
+    return max(1, round(source_size[0] * scale)), max(1, round(source_size[1] * scale))
+
+def normalize_image(content: bytes, size: tuple = IMAGE_SIZE) -> BytesIO:
+    """
+    Decode downloaded image bytes, scale them to fit within `size` keeping the aspect
+    ratio, and re-encode as JPEG. Oversized inputs are rejected before decoding, and
+    JPEGs are decoded in draft mode so the decoder downscales by up to 8x instead of
+    inflating every pixel.
+    """
+    if len(content) > IMAGE_MAX_DOWNLOAD_BYTES:
+        raise ValueError(f"image is larger than {IMAGE_MAX_DOWNLOAD_BYTES // (1024 * 1024)} MB")
+    
+    img = Image.open(BytesIO(content))  # Reads the header only
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        raise ValueError(f"image has {img.width}x{img.height} pixels, more than the {IMAGE_MAX_PIXELS} pixel limit")
+    
+    target = _fit_size(img.size, size)
+    if img.format == 'JPEG':
+        # Smallest DCT scale that is still at least the target size
+        img.draft('RGB', target)
+    
+    img = _to_rgb(img)
+    if img.size != target:
+        img = img.resize(target, _resample_filter(img.size, target), reducing_gap=3.0)
+    
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY)
+    output.seek(0)
+    return output
+
+# Rendered placeholders kept in memory; each is a few KB
+PLACEHOLDER_CACHE_SIZE = int(os.getenv("PLACEHOLDER_CACHE_SIZE", "256"))
+
+def _placeholder_colors(text: str) -> tuple:
+    """Colour pair derived from the text hash, consistent per title."""
+    text_hash = hashlib.md5(text.encode()).hexdigest()
+    # Ensure colors are not too dark
+    start = tuple(max(int(text_hash[i:i + 2], 16), 80) for i in (0, 2, 4))
+    end = tuple(int(channel * 0.55) for channel in start)
+    return start, end
+
+@lru_cache(maxsize=8)
+def _placeholder_font(size: int):
+    for name in ("DejaVuSans-Bold.ttf", "Arial Bold.ttf", "arialbd.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+@lru_cache(maxsize=PLACEHOLDER_CACHE_SIZE)
+def render_placeholder(text: str, size: tuple = IMAGE_SIZE, colors: tuple = None) -> bytes:
+    """
+    Diagonal gradient with the title on top, as JPEG bytes. Built from whole-image
+    operations (gradient resize, channel add, colorize LUT) and memoized by
+    (text, size, colors), so repeated placeholders cost a dictionary lookup.
+    """
+    start, end = colors or _placeholder_colors(text)
+    width, height = size
+    
+    # Build the 256x256 gradient once and scale it; smooth gradients survive bilinear upscaling
+    vertical = Image.linear_gradient('L')
+    mask = ImageChops.add(vertical, vertical.rotate(90), scale=2.0)
+    img = ImageOps.colorize(mask, start, end).resize(size, Image.Resampling.BILINEAR)
+    
+    if text:
+        font = _placeholder_font(max(12, height // 12))
+        chars_per_line = max(8, int(width * 0.8 / max(1, font.getlength("n"))))
+        lines = textwrap.wrap(text, width=chars_per_line)[:3]
+        draw = ImageDraw.Draw(img)
+        center = (width // 2, height // 2)
+        shadow_offset = max(1, height // 200)
+        draw.multiline_text((center[0] + shadow_offset, center[1] + shadow_offset), "\n".join(lines),
+                            font=font, fill=(0, 0, 0), anchor="mm", align="center")
+        draw.multiline_text(center, "\n".join(lines), font=font, fill=(255, 255, 255), anchor="mm", align="center")
+    
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+class RecentImageURLs:
+    """Least-recently-used set of image URLs with a fixed size, shared by all exports."""
+    
+    def __init__(self, max_urls: int = IMAGE_DEDUP_MAX_URLS):
+        self.max_urls = max_urls
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, url: str) -> bool:
+        with self._lock:
+            return url in self._urls
+    
+    def __len__(self) -> int:
+        return len(self._urls)
+    
+    def add(self, url: str):
+        with self._lock:
+            self._urls[url] = None
+            self._urls.move_to_end(url)
+            while len(self._urls) > self.max_urls:
+                self._urls.popitem(last=False)
+
+class DedupScope:
+    """Image URLs used by one export; images are fetched concurrently, so claims are atomic."""
+    
+    def __init__(self):
+        self._urls = set()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, url: str) -> bool:
+        with self._lock:
+            return url in self._urls
+    
+    def claim(self, url: str, recent: RecentImageURLs = None) -> bool:
+        """Reserve a URL for this export; False if another slide already has it.
+        A claimed URL is also recorded in `recent`, if given."""
+        with self._lock:
+            if url in self._urls:
+                return False
+            self._urls.add(url)
+        if recent is not None:
+            recent.add(url)
+        return True
+
+class PendingClaims:
+    """Claims of one source in an image race, applied to the export's scope only if its image wins."""
+    
+    def __init__(self, scope: DedupScope):
+        self.scope = scope
+        self._claims = []
+    
+    def __contains__(self, url: str) -> bool:
+        return url in self.scope or any(url == claimed for claimed, _ in self._claims)
+    
+    def claim(self, url: str, recent: RecentImageURLs = None) -> bool:
+        if url in self:
+            return False
+        self._claims.append((url, recent))
+        return True
+    
+    def commit(self):
+        for url, recent in self._claims:
+            self.scope.claim(url, recent)
+
+class SlideClaims:
+    """One slide's view of the export's scope; remembers the URLs the slide ended up using."""
+    
+    def __init__(self, scope: DedupScope):
+        self.scope = scope
+        self.urls = []
+    
+    def __contains__(self, url: str) -> bool:
+        return url in self.scope
+    
+    def claim(self, url: str, recent: RecentImageURLs = None) -> bool:
+        if not self.scope.claim(url, recent):
+            return False
+        self.urls.append(url)
+        return True
+
+def _source_setting(name: str, setting: str, default):
+    value = os.getenv(f"IMAGE_SOURCE_{name.upper()}_{setting.upper()}")
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() == "true"
+    return float(value)
+
+class ImageSource:
+    """
+    One online image source: its config plus lifetime counters (latency histogram, bytes
+    downloaded) and a circuit breaker whose rolling window drives ordering and skipping.
+    """
+    
+    def __init__(self, name: str, fetch, priority: float, timeout: float, cost: float = 0, enabled: bool = True):
+        self.name = name
+        self.fetch = fetch
+        self.priority = priority
+        self.timeout = timeout
+        self.cost = cost
+        self.enabled = enabled
+        self.breaker = CircuitBreaker(f"image source {name}", window_seconds=IMAGE_SOURCE_WINDOW_SECONDS,
+                                      slow_call_seconds=timeout, open_seconds=IMAGE_SOURCE_OPEN_SECONDS)
+        self.calls = 0
+        self.successes = 0
+        self.bytes_fetched = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_SECONDS) + 1)
+        self._lock = threading.Lock()
+    
+    def fetch_image(self, query: str, dedup: DedupScope = None, cancelled: threading.Event = None) -> BytesIO:
+        """Call the source through its breaker, recording latency and outcome."""
+        if not self.breaker.allow_request():
+            print(f"ℹ Skipping {self.name}: circuit {self.breaker.state}")
+            return None
+        started = time.monotonic()
+        try:
+            image_data = self.fetch(query, dedup=dedup, timeout=self.timeout, cancelled=cancelled)
+        except Exception as e:
+            print(f"✗ {self.name} failed: {str(e)}")
+            image_data = None
+        latency = time.monotonic() - started
+        
+        if cancelled is not None and cancelled.is_set():
+            # Abandoned because another source won the race: not a failure of this source
+            self.breaker.release(latency)
+            return None
+        with self._lock:
+            self.calls += 1
+            self.successes += 1 if image_data else 0
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_SECONDS) if latency <= bound), -1)
+            self.histogram[bucket] += 1
+        if image_data:
+            self.breaker.record_success(latency)
+        else:
+            self.breaker.record_failure(latency)
+        return image_data
+    
+    def add_bytes(self, count: int):
+        with self._lock:
+            self.bytes_fetched += count
+    
+    def rank(self) -> float:
+        """Ordering key: configured priority and cost, plus expected seconds to an image."""
+        window = self.breaker.stats()
+        median = self.breaker.latency_percentile(50, successful_only=False)
+        expected = 0.0
+        if median is not None:
+            expected = median / max(1.0 - window["error_rate"], 0.1)
+        return self.priority + self.cost + IMAGE_SOURCE_LATENCY_WEIGHT * expected
+    
+    def stats(self) -> dict:
+        with self._lock:
+            labels = [f"le_{bound}s" for bound in LATENCY_BUCKETS_SECONDS] + ["le_inf"]
+            counters = {
+                "calls": self.calls,
+                "success_rate": round(self.successes / self.calls, 3) if self.calls else None,
+                "bytes_fetched": self.bytes_fetched,
+                "latency_histogram": dict(zip(labels, self.histogram))
+            }
+        return dict(counters, name=self.name, enabled=self.enabled, priority=self.priority,
+                    timeout_seconds=self.timeout, cost=self.cost, rank=round(self.rank(), 3),
+                    window=self.breaker.stats())
+
+class ImageSourceRegistry:
+    """Online image sources, ordered by observed success and latency on top of their config."""
+    
+    def __init__(self):
+        self._sources = {}
+    
+    def register(self, name: str, fetch, available: bool = True):
+        """Add a source with IMAGE_SOURCE_DEFAULTS overridden by IMAGE_SOURCE_<NAME>_* settings."""
+        defaults = IMAGE_SOURCE_DEFAULTS.get(name, {})
+        self._sources[name] = ImageSource(
+            name, fetch,
+            priority=_source_setting(name, "priority", defaults.get("priority", len(self._sources))),
+            timeout=_source_setting(name, "timeout", defaults.get("timeout", 8)),
+            cost=_source_setting(name, "cost", defaults.get("cost", 0)),
+            enabled=available and _source_setting(name, "enabled", defaults.get("enabled", True))
+        )
+    
+    def get(self, name: str) -> ImageSource:
+        return self._sources.get(name)
+    
+    def add_bytes(self, name: str, count: int):
+        source = self._sources.get(name)
+        if source:
+            source.add_bytes(count)
+    
+    def ordered(self) -> list:
+        """Enabled sources best first; sources with an open circuit are left out until they may probe."""
+        candidates = [
+            source for source in self._sources.values()
+            if source.enabled and source.breaker.state != CircuitBreaker.OPEN
+        ]
+        return sorted(candidates, key=lambda source: source.rank())
+    
+    def stats(self) -> list:
+        return sorted((source.stats() for source in self._sources.values()), key=lambda stats: stats["rank"])
+
 class ImageService:
     def __init__(self):
         self.unsplash_access_key = os.getenv("UNSPLASH_ACCESS_KEY", "")
         self.gemini_api_key = os.getenv("GEMINI_API_KEY", "")
         self.google_search_api_key = os.getenv("GOOGLE_SEARCH_API_KEY", "")
         self.google_search_engine_id = os.getenv("GOOGLE_SEARCH_ENGINE_ID", "")
-        self.used_images = set()  # Track used image URLs to avoid duplicates
+        # Recently used image URLs, preferred against (not excluded) so exports stay independent
+        self.recent_images = RecentImageURLs()
+        
+        # Keep-alive connections reused across slides and exports (per host)
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=IMAGE_HTTP_POOL_SIZE, pool_maxsize=IMAGE_HTTP_POOL_SIZE)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        
+        # Final image bytes on disk, so unchanged decks export without network calls
+        self.cache = create_image_cache_from_env()
+        
+        # Online sources in adaptive order
+        self.sources = ImageSourceRegistry()
+        self.sources.register("google", self._fetch_from_google_search,
+                              available=bool(self.google_search_api_key and self.google_search_engine_id))
+        self.sources.register("pexels", self._fetch_from_pexels)
+        self.sources.register("picsum", self._fetch_from_picsum)
+        self.sources.register("pollinations", self._generate_with_ai)
+        
+        # Licensed images on local disk, searched before any network source
+        self.library = create_image_library_from_env()
+        self.library_hits = 0
+        self.library_misses = 0
         
         # Initialize Gemini for image generation if API key is available
         if self.gemini_api_key:
@@ -36,51 +420,181 @@ class ImageService:
             print("✓ Google Image Search enabled")
         else:
             print("ℹ Google Image Search not configured (optional)")
-        
-    def generate_slide_image(self, slide_title: str, main_topic: str) -> BytesIO:
+    
+    def generate_slide_image(self, slide_title: str, main_topic: str, dedup: DedupScope = None,
+                             colors: tuple = None) -> BytesIO:
         """
         Generate or fetch a relevant image for a slide.
-        Uses Unsplash API for free stock photos.
+        Uses Unsplash API for free stock photos. `dedup` holds the URLs already used by
+        the same export so its slides get different images. `colors` is the (start, end)
+        RGB pair of the deck's theme for placeholders; None derives one from the title.
         """
+        dedup = dedup or DedupScope()
+        image_data = self._fetch_from_library(slide_title, main_topic, dedup)
+        if image_data:
+            return image_data
+        
+        cache_key = placeholder_key = None
+        if self.cache:
+            query_key = normalize_query(slide_title, main_topic)
+            cache_key = self.cache.make_key(query_key, "fit-%dx%d.jpg" % IMAGE_SIZE)
+            # Placeholders depend on the theme, so they are cached apart from network images
+            placeholder_key = self.cache.make_key(query_key, "placeholder-%dx%d-%s.jpg" % (IMAGE_SIZE + (colors,)))
+            try:
+                cached = self.cache.get(cache_key) or self.cache.get(placeholder_key)
+                if cached:
+                    print(f"✓ Image cache hit for '{slide_title}'")
+                    return BytesIO(cached)
+            except Exception as e:
+                print(f"✗ Image cache read error: {str(e)}")
+        
         try:
             # Create search query from slide title and topic
             query = f"{slide_title} {main_topic}".replace(':', '').replace('?', '')
             
             # Try Unsplash first (free, no API key needed for basic use)
-            image_data = self._fetch_unsplash_image(query)
+            image_data = self._fetch_unsplash_image(query, dedup) if IMAGE_NETWORK_SOURCES else None
             
             if image_data:
+                self._store_in_cache(cache_key, image_data, "network")
                 return image_data
             
             # Fallback: Create a simple colored placeholder
-            return self._create_placeholder_image(slide_title)
-            
+            image_data = self._create_placeholder_image(slide_title, colors=colors)
+            self._store_in_cache(placeholder_key, image_data, "placeholder", IMAGE_CACHE_PLACEHOLDER_TTL_SECONDS)
+            return image_data
+        
         except Exception as e:
             print(f"Image generation error: {str(e)}")
-            return self._create_placeholder_image(slide_title)
+            return self._create_placeholder_image(slide_title, colors=colors)
     
-    def _fetch_unsplash_image(self, query: str) -> BytesIO:
-        """Fetch unique image using multiple sources - prioritize relevance and speed"""
+    def _fetch_from_library(self, slide_title: str, main_topic: str, dedup: DedupScope) -> BytesIO:
+        """Best unused match from the local image library, normalized like network images."""
+        if not self.library:
+            return None
         try:
-            # Try multiple sources in order - prioritize Google for relevance
-            sources = [
-                ('Google Search', self._fetch_from_google_search),
-                ('Pexels', self._fetch_from_pexels),
-                ('Picsum', self._fetch_from_picsum),
-            ]
+            matches = self.library.search(f"{slide_title} {main_topic}")
+            path = next((path for _, path in matches if dedup.claim(f"library:{path}")), None)
+            if path is None:
+                self.library_misses += 1
+                return None
             
-            for source_name, source_func in sources:
-                try:
-                    print(f"\n📸 Trying {source_name} for '{query}'...")
-                    image_data = source_func(query)
-                    if image_data:
-                        print(f"✓ Successfully fetched image from {source_name} for '{query}'")
-                        return image_data
-                    else:
-                        print(f"✗ {source_name} returned no image")
-                except Exception as e:
-                    print(f"✗ {source_name} failed: {str(e)}")
-                    continue
+            cache_key = None
+            if self.cache:
+                cache_key = self.cache.make_key(f"{path}|{os.path.getmtime(path)}", "fit-%dx%d.jpg" % IMAGE_SIZE)
+                cached = self.cache.get(cache_key)
+                if cached:
+                    self.library_hits += 1
+                    return BytesIO(cached)
+            with open(path, 'rb') as f:
+                image_data = normalize_image(f.read())
+            self._store_in_cache(cache_key, image_data, "library")
+            self.library_hits += 1
+            print(f"✓ Local library image for '{slide_title}': {os.path.basename(path)}")
+            return image_data
+        except Exception as e:
+            print(f"✗ Local library lookup failed: {str(e)}")
+            return None
+    
+    def prefetch_images(self, slide_titles: list, main_topic: str, colors: tuple = None,
+                        scopes: list = None) -> list:
+        """
+        Fetch images for all slides in parallel before the document is assembled,
+        so export time is bounded by the slowest image instead of the sum.
+        Returns image data (or None) in the same order as slide_titles. `scopes` gives each
+        slide's dedup scope (e.g. SlideClaims on one export scope); by default all slides
+        share a fresh DedupScope.
+        """
+        if not slide_titles:
+            return []
+        scopes = scopes or [DedupScope()] * len(slide_titles)
+        
+        def fetch(title, dedup):
+            try:
+                return self.generate_slide_image(title, main_topic, dedup, colors)
+            except Exception as e:
+                print(f"✗ Image prefetch failed for '{title}': {e}")
+                return None
+        
+        workers = max(1, min(IMAGE_PREFETCH_WORKERS, len(slide_titles)))
+        print(f"\n🖼️  Prefetching {len(slide_titles)} images ({workers} at a time)")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image") as executor:
+            return list(executor.map(fetch, slide_titles, scopes))
+    
+    def render_for_slot(self, image_data: BytesIO, width_emu: int, height_emu: int = None) -> BytesIO:
+        """
+        Render an image for a layout slot of width x height EMU at IMAGE_RENDER_DPI, centre
+        cropped to the slot's aspect ratio instead of being stretched. Without a height the
+        image keeps its own aspect ratio. Images are never upscaled; python-pptx/docx scale
+        the picture to the slot. Variants are cached by (image bytes, pixel size).
+        """
+        content = image_data.getvalue()
+        img = Image.open(BytesIO(content))
+        
+        target_w = width_emu / EMU_PER_INCH * IMAGE_RENDER_DPI
+        target_h = height_emu / EMU_PER_INCH * IMAGE_RENDER_DPI if height_emu else target_w * img.height / img.width
+        # Keep the slot's aspect ratio but stay within the source pixels
+        scale = min(img.width / target_w, img.height / target_h, 1.0)
+        size = (max(1, round(target_w * scale)), max(1, round(target_h * scale)))
+        if size == img.size:
+            return BytesIO(content)
+        
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(hashlib.sha256(content).hexdigest(), "slot-%dx%d.jpg" % size)
+            try:
+                cached = self.cache.get(cache_key)
+                if cached:
+                    return BytesIO(cached)
+            except Exception as e:
+                print(f"✗ Image cache read error: {str(e)}")
+        
+        img = ImageOps.fit(_to_rgb(img), size, _resample_filter(img.size, size), centering=(0.5, 0.5))
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY)
+        output.seek(0)
+        self._store_in_cache(cache_key, output, "slot")
+        return output
+    
+    def _store_in_cache(self, cache_key: str, image_data: BytesIO, source: str, ttl: int = None):
+        if not cache_key or image_data is None:
+            return
+        try:
+            self.cache.set(cache_key, image_data.getvalue(), source=source, ttl=ttl)
+        except Exception as e:
+            print(f"✗ Image cache write error: {str(e)}")
+    
+    def get_metrics(self) -> dict:
+        """Image cache, local library and per-source counters."""
+        return {
+            "cache": self.cache.stats() if self.cache else None,
+            "library": {
+                "images": len(self.library),
+                "hits": self.library_hits,
+                "misses": self.library_misses
+            } if self.library else None,
+            "recent_urls": len(self.recent_images),
+            "sources": self.sources.stats()
+        }
+    
+    def _fetch_unsplash_image(self, query: str, dedup: DedupScope) -> BytesIO:
+        """Fetch a unique image from the registered online sources, best ranked first"""
+        try:
+            sources = self.sources.ordered()
+            if not sources:
+                print(f"✗ No image source available for '{query}'")
+                return None
+            
+            if IMAGE_SOURCE_RACING:
+                return self._race_sources(query, sources, dedup)
+            
+            for source in sources:
+                print(f"\n📸 Trying {source.name} for '{query}'...")
+                image_data = source.fetch_image(query, dedup=dedup)
+                if image_data:
+                    print(f"✓ Successfully fetched image from {source.name} for '{query}'")
+                    return image_data
+                print(f"✗ {source.name} returned no image")
             
             print(f"✗ All image sources failed for '{query}'")
             return None
@@ -88,7 +602,127 @@ class ImageService:
             print(f"✗ All image sources failed: {str(e)}")
             return None
     
-    def _fetch_from_google_search(self, query: str) -> BytesIO:
+    def _race_sources(self, query: str, sources: list, dedup: DedupScope) -> BytesIO:
+        """
+        Query sources concurrently in priority order. Source n starts after n head starts,
+        or as soon as every higher priority source has finished. The highest priority
+        image available is returned within IMAGE_FETCH_DEADLINE_SECONDS; a lower priority
+        image waits at most IMAGE_RACE_GRACE_SECONDS for better ones still in flight.
+        Only the winning source's image URLs are claimed for the export.
+        """
+        started_at = time.monotonic()
+        deadline = started_at + IMAGE_FETCH_DEADLINE_SECONDS
+        settle_by = deadline
+        executor = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="image-source")
+        cancelled = threading.Event()
+        claims = [PendingClaims(dedup) for _ in sources]
+        futures = {}  # future -> source priority
+        finished = set()
+        results = {}
+        
+        def won(priority):
+            claims[priority].commit()
+            return results[priority]
+        
+        try:
+            while True:
+                now = time.monotonic()
+                
+                # Start the next source once its head start has passed or everything before it is done
+                while len(futures) < len(sources) and (
+                        now >= started_at + len(futures) * IMAGE_RACE_HEAD_START_SECONDS or
+                        len(finished) == len(futures)):
+                    priority = len(futures)
+                    print(f"\n📸 Trying {sources[priority].name} for '{query}'...")
+                    futures[executor.submit(sources[priority].fetch_image, query, claims[priority], cancelled)] = priority
+                
+                for future, priority in futures.items():
+                    if future.done() and priority not in finished:
+                        finished.add(priority)
+                        try:
+                            image_data = future.result()
+                        except Exception as e:
+                            print(f"✗ {sources[priority].name} failed: {str(e)}")
+                            image_data = None
+                        if image_data:
+                            results[priority] = image_data
+                            settle_by = min(settle_by, now + IMAGE_RACE_GRACE_SECONDS)
+                        else:
+                            print(f"✗ {sources[priority].name} returned no image")
+                
+                # The best result wins as soon as every higher priority source has finished
+                for priority in range(len(sources)):
+                    if priority in results:
+                        print(f"✓ Successfully fetched image from {sources[priority].name} for '{query}'")
+                        return won(priority)
+                    if priority not in finished:
+                        break
+                
+                if len(finished) == len(sources):
+                    print(f"✗ All image sources failed for '{query}'")
+                    return None
+                if now >= settle_by or now >= deadline:
+                    if results:
+                        best = min(results)
+                        print(f"✓ Using {sources[best].name} image for '{query}' (higher priority sources still pending)")
+                        return won(best)
+                    print(f"✗ No image source answered within {IMAGE_FETCH_DEADLINE_SECONDS:.0f}s for '{query}'")
+                    return None
+                
+                next_start = started_at + len(futures) * IMAGE_RACE_HEAD_START_SECONDS if len(futures) < len(sources) else deadline
+                pending = [future for future in futures if not future.done()]
+                if not pending:
+                    # Everything started has finished, start the next source right away
+                    continue
+                timeout = max(0.0, min(next_start, settle_by, deadline) - now)
+                wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        finally:
+            # Sources that have not started are dropped; running downloads stop at their next chunk
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _download(self, url: str, timeout: float, headers: dict = None, cancelled: tuple = (),
+                  source: str = None) -> bytes:
+        """
+        Stream a download over the pooled session. Returns None on error, when the body
+        exceeds IMAGE_MAX_DOWNLOAD_BYTES, or when any event in `cancelled` is set mid-download.
+        Bytes read are counted against `source`, including abandoned downloads.
+        """
+        with self.http.get(url, timeout=timeout, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                print(f"  Image download failed: status={response.status_code}")
+                return None
+            declared = int(response.headers.get('Content-Length') or 0)
+            if declared > IMAGE_MAX_DOWNLOAD_BYTES:
+                print(f"  Skipping oversized image ({declared / 1024 / 1024:.1f} MB): {url[:50]}...")
+                return None
+            
+            body = bytearray()
+            try:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    if any(event is not None and event.is_set() for event in cancelled):
+                        return None
+                    body.extend(chunk)
+                    if len(body) > IMAGE_MAX_DOWNLOAD_BYTES:
+                        print(f"  Image exceeded {IMAGE_MAX_DOWNLOAD_BYTES // (1024 * 1024)} MB, abandoned: {url[:50]}...")
+                        return None
+                return bytes(body)
+            finally:
+                if source:
+                    self.sources.add_bytes(source, len(body))
+    
+    def _download_google_candidate(self, image_url: str, cancelled: tuple, timeout: float = 8) -> BytesIO:
+        """Download and normalize one Google result; None if it is unusable."""
+        print(f"  Trying to download: {image_url[:50]}...")
+        content = self._download(image_url, timeout=timeout, headers={'User-Agent': BROWSER_USER_AGENT},
+                                 cancelled=cancelled, source="google")
+        if not content or len(content) <= 1000:
+            return None
+        
+        return normalize_image(content)
+    
+    def _fetch_from_google_search(self, query: str, dedup: DedupScope = None, timeout: float = 10,
+                                  cancelled: threading.Event = None) -> BytesIO:
         """Fetch most relevant image from Google Custom Search API"""
         if not self.google_search_api_key or not self.google_search_engine_id:
             return None
@@ -119,7 +753,8 @@ class ImageService:
             print(f"🔍 Searching Google Images for '{search_query}'...")
             print(f"   API Key: {self.google_search_api_key[:10]}... Engine ID: {self.google_search_engine_id}")
             
-            response = requests.get(url, params=params, timeout=10)
+            response = self.http.get(url, params=params, timeout=timeout)
+            self.sources.add_bytes("google", len(response.content))
             
             # Debug: Print response status and any errors
             if response.status_code != 200:
@@ -130,59 +765,54 @@ class ImageService:
             data = response.json()
             
             if 'items' in data and len(data['items']) > 0:
-                # Try to download the first few images until one works
+                dedup = dedup or DedupScope()
+                fresh, recent = [], []
                 for item in data['items'][:3]:
-                    try:
-                        image_url = item['link']
-                        
-                        # Skip if we've used this image before
-                        if image_url in self.used_images:
-                            print(f"  Skipping duplicate: {image_url[:50]}...")
-                            continue
-                        
-                        print(f"  Trying to download: {image_url[:50]}...")
-                        
-                        # Download the image
-                        img_response = requests.get(image_url, timeout=8, headers={
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                        })
-                        
-                        if img_response.status_code == 200 and len(img_response.content) > 1000:
-                            self.used_images.add(image_url)
-                            
-                            image_data = BytesIO(img_response.content)
-                            img = Image.open(image_data)
-                            
-                            # Convert to RGB if needed
-                            if img.mode in ('RGBA', 'LA', 'P'):
-                                img = img.convert('RGB')
-                            
-                            # Resize to standard size
-                            img = img.resize((800, 600), Image.Resampling.LANCZOS)
-                            
-                            output = BytesIO()
-                            img.save(output, format='JPEG', quality=85)
-                            output.seek(0)
-                            
-                            print(f"✓ Google Image downloaded successfully for '{search_query}'")
-                            return output
-                        else:
-                            print(f"  Image download failed: status={img_response.status_code}, size={len(img_response.content)}")
-                    except Exception as e:
-                        print(f"  Failed to process image: {str(e)}")
+                    image_url = item.get('link')
+                    # Never repeat an image within one export
+                    if not image_url or image_url in dedup:
+                        print(f"  Skipping duplicate: {str(image_url)[:50]}...")
                         continue
+                    # Prefer images other exports have not used lately, but don't exclude them
+                    (recent if image_url in self.recent_images else fresh).append(image_url)
+                candidates = fresh or recent
+                
+                # Download all candidates at once; the first valid image wins
+                if candidates:
+                    found = threading.Event()
+                    executor = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="google-image")
+                    try:
+                        futures = {
+                            executor.submit(self._download_google_candidate, image_url, (found, cancelled), timeout): image_url
+                            for image_url in candidates
+                        }
+                        for future in as_completed(futures):
+                            try:
+                                output = future.result()
+                            except Exception as e:
+                                print(f"  Failed to process image: {str(e)}")
+                                continue
+                            # Another slide of this export may have claimed the same URL meanwhile
+                            if output and dedup.claim(futures[future], self.recent_images):
+                                print(f"✓ Google Image downloaded successfully for '{search_query}'")
+                                return output
+                    finally:
+                        # Stop the slower downloads between chunks
+                        found.set()
+                        executor.shutdown(wait=False, cancel_futures=True)
                 
                 print(f"✗ All Google images failed to download for '{search_query}'")
             else:
                 print(f"✗ No images found in Google results for '{search_query}'")
             
             return None
-            
+        
         except Exception as e:
             print(f"✗ Google Image Search failed: {str(e)}")
             return None
     
-    def _fetch_from_pexels(self, query: str) -> BytesIO:
+    def _fetch_from_pexels(self, query: str, dedup: DedupScope = None, timeout: float = 8,
+                           cancelled: threading.Event = None) -> BytesIO:
         """Fetch relevant images from Pexels (free, no API key needed)"""
         try:
             # Extract key terms for better search
@@ -202,25 +832,19 @@ class ImageService:
             
             print(f"Trying Pexels for '{query}' with search: {search_query}")
             
-            response = requests.get(url, timeout=8)
-            if response.status_code == 200 and len(response.content) > 1000:
-                image_data = BytesIO(response.content)
-                img = Image.open(image_data)
-                img = img.resize((800, 600), Image.Resampling.LANCZOS)
-                
-                output = BytesIO()
-                img.save(output, format='PNG')
-                output.seek(0)
-                return output
+            content = self._download(url, timeout=timeout, cancelled=(cancelled,), source="pexels")
+            if content and len(content) > 1000:
+                return normalize_image(content)
             
             return None
-            
+        
         except Exception as e:
             print(f"Pexels fetch failed: {str(e)}")
             return None
     
-    def _generate_with_ai(self, query: str) -> BytesIO:
-        """Generate image using AI - only as fallback due to speed"""
+    def _generate_with_ai(self, query: str, dedup: DedupScope = None, timeout: float = 15,
+                          cancelled: threading.Event = None) -> BytesIO:
+        """Generate image with Pollinations.ai - slow, so registered last and disabled by default"""
         try:
             # Extract key terms for better image generation
             keywords = query.lower().split()
@@ -238,25 +862,20 @@ class ImageService:
             
             print(f"Generating AI image for '{query}'...")
             
-            response = requests.get(url, timeout=15)  # Reduced timeout
-            if response.status_code == 200 and len(response.content) > 1000:
-                image_data = BytesIO(response.content)
-                img = Image.open(image_data)
-                img = img.resize((800, 600), Image.Resampling.LANCZOS)
-                
-                output = BytesIO()
-                img.save(output, format='PNG')
-                output.seek(0)
+            content = self._download(url, timeout=timeout, cancelled=(cancelled,), source="pollinations")
+            if content and len(content) > 1000:
+                output = normalize_image(content)
                 print(f"✓ AI image generated")
                 return output
             
             return None
-            
+        
         except Exception as e:
             print(f"AI generation skipped: {str(e)}")
             return None
     
-    def _fetch_from_picsum(self, query: str) -> BytesIO:
+    def _fetch_from_picsum(self, query: str, dedup: DedupScope = None, timeout: float = 3,
+                           cancelled: threading.Event = None) -> BytesIO:
         """Fetch from Picsum Photos (Lorem Picsum) - reliable and free"""
         # Generate unique ID based on query to get different images
         query_hash = int(hashlib.md5(query.encode()).hexdigest()[:8], 16)
@@ -265,42 +884,17 @@ class ImageService:
         url = f"https://picsum.photos/id/{image_id}/800/600"
         print(f"Trying Picsum with ID {image_id} for '{query}'")
         
-        response = requests.get(url, timeout=3)
-        if response.status_code == 200:
-            image_data = BytesIO(response.content)
-            img = Image.open(image_data)
-            img = img.resize((800, 600), Image.Resampling.LANCZOS)
-            
-            output = BytesIO()
-            img.save(output, format='PNG')
-            output.seek(0)
-            return output
+        content = self._download(url, timeout=timeout, cancelled=(cancelled,), source="picsum")
+        if content:
+            return normalize_image(content)
         return None
     
-
     
-    def _create_placeholder_image(self, text: str) -> BytesIO:
-        """Create a unique colored placeholder image based on text"""
+    
+    def _create_placeholder_image(self, text: str, size: tuple = IMAGE_SIZE, colors: tuple = None) -> BytesIO:
+        """Create a gradient placeholder with the slide title, unique per text"""
         try:
-            # Generate color based on text hash for consistency but uniqueness
-            text_hash = hashlib.md5(text.encode()).hexdigest()
-            r = int(text_hash[0:2], 16)
-            g = int(text_hash[2:4], 16)
-            b = int(text_hash[4:6], 16)
-            
-            # Ensure colors are not too dark
-            r = max(r, 80)
-            g = max(g, 80)
-            b = max(b, 80)
-            
-            # Create a gradient image
-            img = Image.new('RGB', (800, 600), color=(r, g, b))
-            
-            # Save to BytesIO
-            output = BytesIO()
-            img.save(output, format='PNG')
-            output.seek(0)
-            return output
+            return BytesIO(render_placeholder(text, size, colors))
         except Exception as e:
             print(f"Placeholder creation error: {str(e)}")
             return None
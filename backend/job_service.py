@@ -0,0 +1,295 @@
+"""
+Background jobs for long-running generation and export.
+Jobs are stored in the application database so their state survives restarts; work runs
+on an in-process thread pool or, with JOB_WORKER_MODE=process, a separate process pool.
+A queued job is claimed with a conditional UPDATE before it runs, so when several server
+processes share the database each job still runs once.
+"""
+import asyncio
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+
+from database import SessionLocal
+from models import Job, Project, Section
+
+JOB_WORKER_MODE = os.getenv("JOB_WORKER_MODE", "thread")  # thread or process
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_RESULTS_DIR = os.getenv("JOB_RESULTS_DIR", "job_results")
+# Finished export files are deleted after this long (and re-exporting is cheap with the export cache)
+JOB_RESULTS_TTL_SECONDS = int(os.getenv("JOB_RESULTS_TTL_SECONDS", str(24 * 60 * 60)))
+# A running job without progress for this long is treated as interrupted and queued again
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "900"))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+def _load(text: Optional[str]) -> dict:
+    return json.loads(text) if text else {}
+
+def _update_job(session, job: Job, **fields):
+    for name, value in fields.items():
+        setattr(job, name, value)
+    session.commit()
+
+def _set_progress(session, job: Job, progress: dict):
+    _update_job(session, job, progress_json=json.dumps(progress))
+
+async def _generate_sections(session, job: Job, project: Project, sections: list, params: dict):
+    from gemini_service import gemini_service, GENERATION_CONCURRENCY, LLM_BATCHED_GENERATION
+    from rate_limiter import set_current_user
+    
+    set_current_user(job.user_id)
+    progress = _load(job.progress_json)
+    sections_progress = progress.setdefault("sections", {})
+    for section in sections:
+        sections_progress.setdefault(str(section.id), "pending")
+    _set_progress(session, job, progress)
+    
+    use_cache = not params.get("bypass_cache", False)
+    batched = LLM_BATCHED_GENERATION if params.get("batched") is None else params["batched"]
+    if batched:
+        # Sections finished before a restart are not generated again
+        remaining = [section for section in sections if sections_progress[str(section.id)] != "done"]
+        for section in remaining:
+            sections_progress[str(section.id)] = "running"
+        _set_progress(session, job, progress)
+        contents = await gemini_service.agenerate_contents_batched(
+            [section.title for section in remaining], project.main_topic, project.document_type, True,
+            use_cache=use_cache
+        )
+        for section, content in zip(remaining, contents):
+            section.content = content
+            sections_progress[str(section.id)] = "done"
+        _set_progress(session, job, progress)
+        return
+    
+    slots = asyncio.Semaphore(GENERATION_CONCURRENCY)
+    
+    async def generate_one(section):
+        # Sections finished before a restart are not generated again
+        if sections_progress[str(section.id)] == "done":
+            return
+        async with slots:
+            sections_progress[str(section.id)] = "running"
+            _set_progress(session, job, progress)
+            # Assume slides will have images by default
+            section.content = await gemini_service.agenerate_content(
+                section.title, project.main_topic, project.document_type, True, use_cache
+            )
+            sections_progress[str(section.id)] = "done"
+            _set_progress(session, job, progress)
+    
+    await asyncio.gather(*(generate_one(section) for section in sections))
+
+def _run_generate(session, job: Job, params: dict):
+    project = session.query(Project).filter(Project.id == job.project_id).first()
+    query = session.query(Section).filter(Section.project_id == job.project_id)
+    if params.get("section_id"):
+        query = query.filter(Section.id == params["section_id"])
+    sections = query.all()
+    # Each job runs on its own worker thread, so it gets its own event loop
+    asyncio.run(_generate_on_job_loop(session, job, project, sections, params))
+
+async def _generate_on_job_loop(session, job: Job, project: Project, sections: list, params: dict):
+    from gemini_service import gemini_service
+    
+    try:
+        await _generate_sections(session, job, project, sections, params)
+    finally:
+        # Provider connections are bound to this loop, which ends with the job
+        await gemini_service.aclose()
+
+def _run_export(session, job: Job, params: dict):
+    from document_service_v2 import DocumentServiceV2
+    
+    project = session.query(Project).filter(Project.id == job.project_id).first()
+    sections = session.query(Section).filter(Section.project_id == job.project_id).all()
+    _set_progress(session, job, {"stage": "rendering", "sections": len(sections)})
+    
+    file, _, filename, media_type = DocumentServiceV2.export_project_cached(project, sections)
+    
+    os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+    extension = os.path.splitext(filename)[1]
+    result_path = os.path.join(JOB_RESULTS_DIR, f"{job.id}{extension}")
+    if isinstance(file, str):
+        shutil.copyfile(file, result_path)
+    else:
+        with file, open(result_path, "wb") as f:
+            shutil.copyfileobj(file, f)
+    
+    _update_job(session, job, result_path=result_path)
+    _set_progress(session, job, {
+        "stage": "done", "sections": len(sections),
+        "filename": filename, "media_type": media_type
+    })
+
+JOB_RUNNERS = {
+    "generate": _run_generate,
+    "export": _run_export
+}
+
+def _claim(session, job_id: str) -> bool:
+    """Move a queued job to running; False if another worker or process got to it first."""
+    claimed = session.query(Job).filter(Job.id == job_id, Job.status == "queued").update(
+        {"status": "running", "error": None, "updated_at": datetime.utcnow()},
+        synchronize_session=False
+    )
+    session.commit()
+    return claimed == 1
+
+def run_job(job_id: str):
+    """Execute one job. Module-level so it can be sent to a process pool."""
+    session = SessionLocal()
+    try:
+        if not _claim(session, job_id):
+            return
+        job = session.query(Job).filter(Job.id == job_id).first()
+        print(f"▶ Job {job.id} ({job.kind}) started for project {job.project_id}")
+        try:
+            JOB_RUNNERS[job.kind](session, job, _load(job.params_json))
+            _update_job(session, job, status="completed", finished_at=datetime.utcnow())
+            print(f"✓ Job {job.id} completed")
+        except Exception as e:
+            session.rollback()
+            _update_job(session, job, status="failed", error=str(e), finished_at=datetime.utcnow())
+            print(f"✗ Job {job.id} failed: {e}")
+    finally:
+        session.close()
+
+class JobService:
+    """Create, run and look up background jobs."""
+    
+    def __init__(self):
+        self._executor = None
+        self._sweeper = None
+    
+    def _get_executor(self):
+        if self._executor is None:
+            if JOB_WORKER_MODE == "process":
+                self._executor = ProcessPoolExecutor(max_workers=JOB_WORKERS)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+            print(f"Job workers: {JOB_WORKERS} ({JOB_WORKER_MODE})")
+        return self._executor
+    
+    def _submit(self, job_id: str):
+        self._get_executor().submit(run_job, job_id)
+    
+    def enqueue(self, db, user_id: int, project_id: int, kind: str, params: dict = None) -> Job:
+        """Queue a job, reusing an identical one that is still queued or running."""
+        params_json = json.dumps(params or {}, sort_keys=True)
+        existing = db.query(Job).filter(
+            Job.project_id == project_id,
+            Job.kind == kind,
+            Job.params_json == params_json,
+            Job.status.in_(ACTIVE_STATUSES)
+        ).first()
+        if existing:
+            return existing
+        
+        job = Job(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            project_id=project_id,
+            kind=kind,
+            status="queued",
+            params_json=params_json
+        )
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        self._submit(job.id)
+        return job
+    
+    def resume_pending(self):
+        """Submit queued jobs and requeue running ones that stopped making progress.
+        
+        Safe to call from every server process: a job only runs in the worker that claims it,
+        and a running job is only requeued once it has been silent for JOB_STALE_SECONDS.
+        """
+        session = SessionLocal()
+        try:
+            stale_before = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+            requeued = session.query(Job).filter(
+                Job.status == "running", Job.updated_at < stale_before
+            ).update({"status": "queued"}, synchronize_session=False)
+            session.commit()
+            job_ids = [job_id for job_id, in session.query(Job.id).filter(Job.status == "queued")]
+        finally:
+            session.close()
+        for job_id in job_ids:
+            self._submit(job_id)
+        if requeued:
+            print(f"ℹ Requeued {requeued} interrupted background jobs")
+    
+    def purge_results(self):
+        """Delete export files older than JOB_RESULTS_TTL_SECONDS, including those of deleted jobs."""
+        if not os.path.isdir(JOB_RESULTS_DIR):
+            return
+        cutoff = time.time() - JOB_RESULTS_TTL_SECONDS
+        expired = []
+        for entry in os.scandir(JOB_RESULTS_DIR):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                expired.append(entry.path)
+        if not expired:
+            return
+        session = SessionLocal()
+        try:
+            session.query(Job).filter(Job.result_path.in_(expired)).update(
+                {"result_path": None}, synchronize_session=False
+            )
+            session.commit()
+        finally:
+            session.close()
+        print(f"ℹ Deleted {len(expired)} expired job results")
+    
+    def start(self):
+        """Resume pending jobs now and keep checking for interrupted ones and expired results."""
+        self.resume_pending()
+        self.purge_results()
+        if self._sweeper is None:
+            self._sweeper = threading.Event()
+            threading.Thread(target=self._sweep, args=(self._sweeper,), name="job-sweeper", daemon=True).start()
+    
+    def _sweep(self, stopped: threading.Event):
+        while not stopped.wait(JOB_STALE_SECONDS / 2):
+            try:
+                self.resume_pending()
+                self.purge_results()
+            except Exception as e:
+                print(f"✗ Job sweep failed: {e}")
+    
+    def get_job(self, db, job_id: str, user_id: int) -> Optional[Job]:
+        return db.query(Job).filter(Job.id == job_id, Job.user_id == user_id).first()
+    
+    def to_response(self, job: Job) -> dict:
+        return {
+            "id": job.id,
+            "project_id": job.project_id,
+            "kind": job.kind,
+            "status": job.status,
+            "progress": _load(job.progress_json),
+            "error": job.error,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at,
+            "finished_at": job.finished_at
+        }
+    
+    def shutdown(self):
+        if self._sweeper is not None:
+            self._sweeper.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+# Global instance
+job_service = JobService()
@@ -0,0 +1,211 @@
+"""
+Response cache for AI provider calls.
+Entries are keyed by a hash of the prompt and generation settings, expire after a TTL
+and are evicted least-recently-used. Backends: in-process, SQLite file or Redis.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")  # memory, sqlite, redis or none
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+LLM_CACHE_SQLITE_PATH = os.getenv("LLM_CACHE_SQLITE_PATH", "llm_cache.db")
+LLM_CACHE_REDIS_URL = os.getenv("LLM_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+class MemoryCacheBackend:
+    """In-process LRU dictionary; entries are lost on restart."""
+    
+    name = "memory"
+    
+    def __init__(self, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def size(self) -> int:
+        return len(self._entries)
+
+class SQLiteCacheBackend:
+    """SQLite file shared by all workers on the same machine."""
+    
+    name = "sqlite"
+    
+    def __init__(self, path: str = LLM_CACHE_SQLITE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_access ON llm_cache (last_access)")
+    
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+    
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+    
+    def set(self, key: str, value: str, ttl: int):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now)
+            )
+            # Drop expired rows, then the least recently used ones above the cap
+            conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+    
+    def size(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+class RedisCacheBackend:
+    """Redis server (e.g. a local instance); LRU eviction follows the server's maxmemory-policy."""
+    
+    name = "redis"
+    
+    def __init__(self, url: str = LLM_CACHE_REDIS_URL):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=1, decode_responses=True)
+        self.client.ping()
+    
+    def get(self, key: str) -> Optional[str]:
+        return self.client.get(f"llm:{key}")
+    
+    def set(self, key: str, value: str, ttl: int):
+        self.client.setex(f"llm:{key}", ttl, value)
+    
+    def size(self) -> int:
+        return sum(1 for _ in self.client.scan_iter("llm:*"))
+
+class LLMResponseCache:
+    """Prompt-hash keyed response cache with hit/miss counters."""
+    
+    def __init__(self, backend=None, ttl: int = LLM_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+    
+    @staticmethod
+    def make_key(namespace: str, prompt: str, **params) -> str:
+        """Content address for a prompt and the settings that influence its output."""
+        payload = json.dumps({"ns": namespace, "prompt": prompt, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+    
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"✗ LLM cache read error: {e}")
+            self._count("errors")
+            return None
+        self._count("hits" if value is not None else "misses")
+        return value
+    
+    def set(self, key: str, value: str):
+        if not self.enabled or not value:
+            return
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            print(f"✗ LLM cache write error: {e}")
+            self._count("errors")
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        try:
+            entries = self.backend.size() if self.enabled else 0
+        except Exception:
+            entries = None
+        return {
+            "backend": self.backend.name if self.enabled else "none",
+            "ttl_seconds": self.ttl,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+def create_cache_from_env() -> LLMResponseCache:
+    """Build the cache configured by LLM_CACHE_BACKEND, falling back to in-process."""
+    backend_name = LLM_CACHE_BACKEND.lower()
+    backend = None
+    try:
+        if backend_name == "none":
+            backend = None
+        elif backend_name == "sqlite":
+            backend = SQLiteCacheBackend()
+        elif backend_name == "redis":
+            backend = RedisCacheBackend()
+        else:
+            backend = MemoryCacheBackend()
+    except Exception as e:
+        print(f"✗ LLM cache backend '{backend_name}' unavailable ({e}), using in-process cache")
+        backend = MemoryCacheBackend()
+    
+    print(f"LLM response cache: {backend.name if backend else 'disabled'}")
+    return LLMResponseCache(backend)
@@ -1,24 +1,32 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, FileResponse
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from datetime import timedelta
 from io import BytesIO
+import asyncio
+import json
+import os
 
-from database import get_db, engine
-from models import Base, User, Project, Section, Refinement, Feedback
+from database import get_db, engine, SessionLocal
+from models import Base, User, Project, Section, Refinement, Feedback, Job
 from schemas import (
     UserCreate, UserLogin, Token, ProjectCreate, ProjectResponse,
     ProjectListResponse, GenerateContentRequest, RefineContentRequest,
-    FeedbackRequest, AITemplateRequest, AITemplateResponse
+    FeedbackRequest, AITemplateRequest, AITemplateResponse, JobResponse
 )
 from auth import (
     get_password_hash, verify_password, create_access_token,
     get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from gemini_service import gemini_service
-from document_service_v2 import DocumentServiceV2
+from gemini_service import gemini_service, GENERATION_CONCURRENCY, LLM_BATCHED_GENERATION
+from rate_limiter import set_current_user
+from document_service_v2 import DocumentServiceV2, iter_file
+from image_service import image_service
+from job_service import job_service
+from export_cache import export_cache
+from slide_cache import slide_cache
 
 # Create database tables
 Base.metadata.create_all(bind=engine)
@@ -37,6 +45,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def resume_background_jobs():
+    # Pick up jobs that were queued or running when the server stopped
+    job_service.start()
+
+@app.on_event("shutdown")
+async def close_llm_connections():
+    # Release pooled keep-alive connections to the AI providers
+    await gemini_service.aclose()
+    job_service.shutdown()
+
 # Authentication endpoints
 @app.post("/auth/register", response_model=Token)
 def register(user_data: UserCreate, db: Session = Depends(get_db)):
@@ -177,12 +196,15 @@ def delete_project(
 
 # Content generation endpoints
 @app.post("/projects/{project_id}/generate")
-def generate_content(
+async def generate_content(
     project_id: int,
     request: GenerateContentRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    # Queue outbound AI calls fairly per user
+    set_current_user(current_user.id)
+    
     project = db.query(Project).filter(
         Project.id == project_id,
         Project.user_id == current_user.id
@@ -200,28 +222,37 @@ def generate_content(
     else:
         sections = db.query(Section).filter(Section.project_id == project_id).all()
     
-    for section in sections:
-        # Assume slides will have images by default
-        has_image = True
-        content = gemini_service.generate_content(
-            section.title,
-            project.main_topic,
-            project.document_type,
-            has_image
-        )
+    # Generate all sections concurrently; the session is only touched from this coroutine
+    # Assume slides will have images by default
+    has_image = True
+    batched = LLM_BATCHED_GENERATION if request.batched is None else request.batched
+    generate = gemini_service.agenerate_contents_batched if batched else gemini_service.agenerate_contents
+    contents = await generate(
+        [section.title for section in sections],
+        project.main_topic,
+        project.document_type,
+        has_image,
+        use_cache=not request.bypass_cache
+    )
+    
+    for section, content in zip(sections, contents):
         section.content = content
     
+    # Commit all sections in a single transaction
     db.commit()
     
     return {"message": "Content generated successfully"}
 
 @app.post("/projects/{project_id}/refine")
-def refine_content(
+async def refine_content(
     project_id: int,
     request: RefineContentRequest,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
+    # Queue outbound AI calls fairly per user
+    set_current_user(current_user.id)
+    
     project = db.query(Project).filter(
         Project.id == project_id,
         Project.user_id == current_user.id
@@ -249,11 +280,21 @@ def refine_content(
     )
     
     # Refine content
-    new_content = gemini_service.refine_content(
-        section.content,
-        request.prompt,
-        project.document_type
-    )
+    try:
+        result = await gemini_service.arefine_section(
+            section.content,
+            request.prompt,
+            project.document_type,
+            target_blocks=request.target_blocks,
+            compact=request.compact,
+            hedge=request.hedge
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    new_content = result["content"]
     
     refinement.new_content = new_content
     section.content = new_content
@@ -261,7 +302,165 @@ def refine_content(
     db.add(refinement)
     db.commit()
     
-    return {"message": "Content refined successfully", "new_content": new_content}
+    return {
+        "message": "Content refined successfully",
+        "new_content": new_content,
+        "mode": result["mode"],
+        "prompt_tokens": result["prompt_tokens"]
+    }
+
+# Streaming variants (Server-Sent Events)
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+JOB_EVENTS_POLL_SECONDS = 0.5
+
+def _sse(event: str, data: dict) -> str:
+    """Format a single Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/projects/{project_id}/generate/stream")
+async def generate_content_stream(
+    project_id: int,
+    request: GenerateContentRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Generate section content, streaming tokens as SSE while the providers produce them."""
+    # Queue outbound AI calls fairly per user
+    set_current_user(current_user.id)
+    
+    project = db.query(Project).filter(
+        Project.id == project_id,
+        Project.user_id == current_user.id
+    ).first()
+    
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Project not found"
+        )
+    
+    if request.section_id:
+        sections = db.query(Section).filter(
+            Section.id == request.section_id,
+            Section.project_id == project_id
+        ).all()
+    else:
+        sections = db.query(Section).filter(Section.project_id == project_id).all()
+    
+    # Capture what the stream needs; the request session is not used after this point
+    targets = [(section.id, section.title) for section in sections]
+    main_topic = project.main_topic
+    document_type = project.document_type
+    use_cache = not request.bypass_cache
+    
+    async def event_stream():
+        queue = asyncio.Queue()
+        slots = asyncio.Semaphore(GENERATION_CONCURRENCY)
+        finished = {}
+        
+        async def stream_section(section_id, title):
+            try:
+                async with slots:
+                    chunks = []
+                    # Assume slides will have images by default
+                    async for text in gemini_service.astream_content(
+                        title, main_topic, document_type, True, use_cache=use_cache
+                    ):
+                        chunks.append(text)
+                        await queue.put(("token", {"section_id": section_id, "text": text}))
+                    finished[section_id] = "".join(chunks)
+                    await queue.put(("section_done", {"section_id": section_id, "content": finished[section_id]}))
+            finally:
+                # Sentinel: this section will not produce more events
+                await queue.put(None)
+        
+        tasks = [asyncio.create_task(stream_section(section_id, title)) for section_id, title in targets]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                item = await queue.get()
+                if item is None:
+                    remaining -= 1
+                    continue
+                event, data = item
+                yield _sse(event, data)
+            yield _sse("done", {"sections": len(finished)})
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Persist every section that finished streaming in one transaction
+            if finished:
+                session = SessionLocal()
+                try:
+                    for section in session.query(Section).filter(Section.id.in_(list(finished))).all():
+                        section.content = finished[section.id]
+                    session.commit()
+                finally:
+                    session.close()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/projects/{project_id}/refine/stream")
+async def refine_content_stream(
+    project_id: int,
+    request: RefineContentRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Refine a section, streaming tokens as SSE and saving the refinement when done."""
+    # Queue outbound AI calls fairly per user
+    set_current_user(current_user.id)
+    
+    project = db.query(Project).filter(
+        Project.id == project_id,
+        Project.user_id == current_user.id
+    ).first()
+    
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Project not found"
+        )
+    
+    section = db.query(Section).filter(Section.id == request.section_id).first()
+    
+    if not section or section.project_id != project_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Section not found"
+        )
+    
+    section_id = section.id
+    previous_content = section.content
+    document_type = project.document_type
+    
+    async def event_stream():
+        chunks = []
+        async for text in gemini_service.astream_refine(previous_content, request.prompt, document_type):
+            chunks.append(text)
+            yield _sse("token", {"section_id": section_id, "text": text})
+        
+        new_content = "".join(chunks)
+        
+        # Store refinement history once the full text is known
+        session = SessionLocal()
+        try:
+            target = session.query(Section).filter(Section.id == section_id).first()
+            if target:
+                session.add(Refinement(
+                    section_id=section_id,
+                    prompt=request.prompt,
+                    previous_content=previous_content,
+                    new_content=new_content
+                ))
+                target.content = new_content
+                session.commit()
+        finally:
+            session.close()
+        
+        yield _sse("done", {"section_id": section_id, "new_content": new_content})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 @app.post("/projects/{project_id}/feedback")
 def submit_feedback(
@@ -304,6 +503,7 @@ def submit_feedback(
 @app.get("/projects/{project_id}/export")
 def export_document(
     project_id: int,
+    if_none_match: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -320,44 +520,173 @@ def export_document(
     
     sections = db.query(Section).filter(Section.project_id == project_id).all()
     
-    # Parse metadata
-    import json
-    metadata = None
-    if project.metadata_json:
+    # Unchanged projects are answered from the content hash alone
+    etag = f'"{DocumentServiceV2.export_etag(project, sections)}"'
+    if if_none_match and etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
+    file, _, filename, media_type = DocumentServiceV2.export_project_cached(project, sections)
+    headers = {"Content-Disposition": f"attachment; filename={filename}", "ETag": etag}
+    
+    if isinstance(file, str):
+        return FileResponse(file, media_type=media_type, headers=headers)
+    return StreamingResponse(iter_file(file), media_type=media_type, headers=headers)
+
+# Background jobs
+def _get_owned_project(db: Session, project_id: int, user_id: int) -> Project:
+    project = db.query(Project).filter(
+        Project.id == project_id,
+        Project.user_id == user_id
+    ).first()
+    
+    if not project:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Project not found"
+        )
+    return project
+
+def _get_owned_job(db: Session, job_id: str, user_id: int) -> Job:
+    job = job_service.get_job(db, job_id, user_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    return job
+
+@app.post("/projects/{project_id}/jobs/generate", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+def enqueue_generation(
+    project_id: int,
+    request: GenerateContentRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    _get_owned_project(db, project_id, current_user.id)
+    job = job_service.enqueue(db, current_user.id, project_id, "generate", request.dict())
+    return job_service.to_response(job)
+
+@app.post("/projects/{project_id}/jobs/export", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+def enqueue_export(
+    project_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    _get_owned_project(db, project_id, current_user.id)
+    job = job_service.enqueue(db, current_user.id, project_id, "export")
+    return job_service.to_response(job)
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+def get_job(
+    job_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    return job_service.to_response(_get_owned_job(db, job_id, current_user.id))
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(
+    job_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    _get_owned_job(db, job_id, current_user.id)
+    user_id = current_user.id
+    
+    def read_job():
+        session = SessionLocal()
         try:
-            metadata = json.loads(project.metadata_json)
-        except:
-            metadata = None
-    
-    if project.document_type == "docx":
-        file_stream = DocumentServiceV2.create_docx(project, sections, metadata)
-        filename = f"{project.title}.docx"
-        media_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    else:
-        file_stream = DocumentServiceV2.create_professional_pptx(project, sections, metadata)
-        filename = f"{project.title}.pptx"
-        media_type = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
-    
-    return StreamingResponse(
-        file_stream,
-        media_type=media_type,
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
+            job = job_service.get_job(session, job_id, user_id)
+            if job is None:
+                return None
+            return json.loads(JobResponse(**job_service.to_response(job)).json())
+        finally:
+            session.close()
+    
+    async def event_stream():
+        # Jobs may run in another process, so progress is read back from the database
+        last = None
+        while True:
+            data = await asyncio.to_thread(read_job)
+            if data is None:
+                # Deleted mid-stream, e.g. together with its project
+                yield _sse("gone", {"id": job_id})
+                return
+            if data != last:
+                yield _sse("progress", data)
+                last = data
+            if data["status"] in ("completed", "failed"):
+                yield _sse(data["status"], data)
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(
+    job_id: str,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    job = _get_owned_job(db, job_id, current_user.id)
+    if job.status != "completed":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Job is {job.status}"
+        )
+    
+    if job.kind == "export":
+        if not job.result_path or not os.path.exists(job.result_path):
+            raise HTTPException(
+                status_code=status.HTTP_410_GONE,
+                detail="Export result has expired, start a new export job"
+            )
+        progress = json.loads(job.progress_json or "{}")
+        return FileResponse(
+            job.result_path,
+            media_type=progress.get("media_type"),
+            filename=progress.get("filename")
+        )
+    
+    params = json.loads(job.params_json or "{}")
+    query = db.query(Section).filter(Section.project_id == job.project_id)
+    if params.get("section_id"):
+        query = query.filter(Section.id == params["section_id"])
+    return {
+        "sections": [
+            {"id": section.id, "title": section.title, "content": section.content}
+            for section in query.all()
+        ]
+    }
 
 # AI Template generation (Bonus feature)
 @app.post("/ai/generate-template", response_model=AITemplateResponse)
-def generate_template(
+async def generate_template(
     request: AITemplateRequest,
     current_user: User = Depends(get_current_user)
 ):
-    titles = gemini_service.generate_template(
+    set_current_user(current_user.id)
+    titles = await gemini_service.agenerate_template(
         request.main_topic,
         request.document_type,
-        request.num_sections
+        request.num_sections,
+        use_cache=not request.bypass_cache
     )
     
     return {"sections": titles}
 
+@app.get("/ai/metrics")
+def get_ai_metrics(current_user: User = Depends(get_current_user)):
+    """Counters for the AI provider layer and the image pipeline."""
+    return dict(
+        gemini_service.get_metrics(),
+        images=image_service.get_metrics(),
+        exports={
+            "files": export_cache.stats() if export_cache else None,
+            "slides": slide_cache.stats() if slide_cache else None
+        }
+    )
+
 @app.get("/")
 def root():
     return {"message": "AI Document Authoring Platform API"}
@@ -27,6 +27,7 @@ class Project(Base):
     
     owner = relationship("User", back_populates="projects")
     sections = relationship("Section", back_populates="project", cascade="all, delete-orphan")
+    jobs = relationship("Job", back_populates="project", cascade="all, delete-orphan")
 
 class Section(Base):
     __tablename__ = "sections"
@@ -66,3 +67,21 @@ class Feedback(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     section = relationship("Section", back_populates="feedbacks")
+
+class Job(Base):
+    __tablename__ = "jobs"
+    
+    id = Column(String, primary_key=True, index=True)  # uuid4 hex
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    project_id = Column(Integer, ForeignKey("projects.id"), nullable=False)
+    kind = Column(String, nullable=False)  # 'generate' or 'export'
+    status = Column(String, nullable=False, default="queued")  # 'queued', 'running', 'completed' or 'failed'
+    params_json = Column(Text, nullable=True)  # Request options as JSON
+    progress_json = Column(Text, nullable=True)  # Per-section progress as JSON
+    result_path = Column(String, nullable=True)  # Rendered file for export jobs
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    project = relationship("Project", back_populates="jobs")
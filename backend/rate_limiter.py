@@ -0,0 +1,301 @@
+"""
+Outbound rate limiting for AI provider calls.
+Each provider gets a requests-per-minute and a tokens-per-minute token bucket. Callers
+wait in a queue that is served round-robin by user, so one large deck cannot starve
+everyone else. Buckets live in-process or in a SQLite file shared by all workers.
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import count
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory or sqlite
+RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", "rate_limits.db")
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "60"))
+# Expected completion size used when reserving tokens before the call
+RATE_LIMIT_COMPLETION_ESTIMATE = int(os.getenv("RATE_LIMIT_COMPLETION_ESTIMATE", "500"))
+
+# Limits per provider; 0 disables that bucket
+PROVIDER_LIMITS = {
+    "groq": {
+        "rpm": int(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30")),
+        "tpm": int(os.getenv("GROQ_TOKENS_PER_MINUTE", "0"))
+    },
+    "gemini": {
+        "rpm": int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "15")),
+        "tpm": int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "0"))
+    }
+}
+
+POLL_INTERVAL_SECONDS = 0.05
+
+# User the current request is made on behalf of, used for fair queueing
+current_user_key = ContextVar("current_user_key", default="anonymous")
+
+def set_current_user(user_key):
+    """Attribute outbound calls made from the current context to a user."""
+    current_user_key.set(str(user_key))
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+class MemoryBucketStore:
+    """Token buckets shared by the threads and tasks of this process."""
+    
+    name = "memory"
+    blocking = False
+    
+    def __init__(self):
+        self._buckets = {}  # name -> (tokens, updated_at)
+        self._lock = threading.Lock()
+    
+    def take(self, amounts: dict, limits: dict) -> float:
+        """Consume every amount if all buckets allow it; otherwise return seconds to wait."""
+        with self._lock:
+            now = time.time()
+            levels = {}
+            wait = 0.0
+            for name, amount in amounts.items():
+                capacity = limits[name]
+                tokens, updated = self._buckets.get(name, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * capacity / 60.0)
+                levels[name] = tokens
+                if tokens < amount:
+                    wait = max(wait, (amount - tokens) * 60.0 / capacity)
+            if wait > 0:
+                for name, tokens in levels.items():
+                    self._buckets[name] = (tokens, now)
+                return wait
+            for name, amount in amounts.items():
+                self._buckets[name] = (levels[name] - amount, now)
+            return 0.0
+    
+    def adjust(self, name: str, delta: float, capacity: int):
+        """Add (or with a negative delta, remove) tokens, e.g. to settle actual usage."""
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.get(name, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * capacity / 60.0)
+            self._buckets[name] = (min(capacity, tokens + delta), now)
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file so all uvicorn workers share one budget."""
+    
+    name = "sqlite"
+    # Waits on other workers' write locks (up to the busy timeout), so never call it on the event loop
+    blocking = True
+    
+    def __init__(self, path: str = RATE_LIMIT_SQLITE_PATH):
+        self.path = path
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+    
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            # Take the write lock up front so refill-check-consume is atomic across processes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+    
+    def _level(self, conn, name: str, capacity: int, now: float) -> float:
+        row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return float(capacity)
+        return min(capacity, row[0] + (now - row[1]) * capacity / 60.0)
+    
+    def _store(self, conn, name: str, tokens: float, now: float):
+        conn.execute(
+            "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+            (name, tokens, now)
+        )
+    
+    def take(self, amounts: dict, limits: dict) -> float:
+        with self._transaction() as conn:
+            now = time.time()
+            levels = {}
+            wait = 0.0
+            for name, amount in amounts.items():
+                levels[name] = self._level(conn, name, limits[name], now)
+                if levels[name] < amount:
+                    wait = max(wait, (amount - levels[name]) * 60.0 / limits[name])
+            if wait > 0:
+                return wait
+            for name, amount in amounts.items():
+                self._store(conn, name, levels[name] - amount, now)
+            return 0.0
+    
+    def adjust(self, name: str, delta: float, capacity: int):
+        with self._transaction() as conn:
+            now = time.time()
+            self._store(conn, name, min(capacity, self._level(conn, name, capacity, now) + delta), now)
+
+class ProviderRateLimiter:
+    """Requests/min and tokens/min limits for one provider with a per-user fair queue."""
+    
+    def __init__(self, provider: str, rpm: int, tpm: int, store):
+        self.provider = provider
+        self.limits = {}
+        if rpm > 0:
+            self.limits[f"{provider}:requests"] = rpm
+        if tpm > 0:
+            self.limits[f"{provider}:tokens"] = tpm
+        self.store = store
+        
+        # user -> deque of ticket ids; the ordering of users is the round-robin order
+        self._queues = OrderedDict()
+        self._tickets = count()
+        self._lock = threading.Lock()
+        
+        self._waits = deque(maxlen=500)
+        self._granted = 0
+        self._timeouts = 0
+        self._throttled = 0
+        self._max_depth = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.limits)
+    
+    def _amounts(self, tokens: int) -> dict:
+        amounts = {}
+        for name, capacity in self.limits.items():
+            # A single call larger than the whole bucket waits for a full bucket instead of forever
+            amounts[name] = 1 if name.endswith(":requests") else min(tokens, capacity)
+        return amounts
+    
+    def _enqueue(self, user_key: str) -> int:
+        with self._lock:
+            ticket = next(self._tickets)
+            self._queues.setdefault(user_key, deque()).append(ticket)
+            self._max_depth = max(self._max_depth, self._depth())
+            return ticket
+    
+    def _depth(self) -> int:
+        return sum(len(tickets) for tickets in self._queues.values())
+    
+    def _is_next(self, ticket: int) -> bool:
+        for tickets in self._queues.values():
+            return tickets[0] == ticket
+        return False
+    
+    def _dequeue(self, user_key: str, ticket: int, served: bool):
+        tickets = self._queues.get(user_key)
+        if tickets is None:
+            return
+        if ticket in tickets:
+            tickets.remove(ticket)
+        if not tickets:
+            del self._queues[user_key]
+        elif served:
+            # Round robin: the user just served goes to the back of the line
+            self._queues.move_to_end(user_key)
+    
+    def _try_acquire(self, user_key: str, ticket: int, tokens: int) -> float:
+        """0 when the ticket was granted, otherwise seconds until it is worth checking again."""
+        with self._lock:
+            if not self._is_next(ticket):
+                return POLL_INTERVAL_SECONDS
+            wait = self.store.take(self._amounts(tokens), self.limits)
+            if wait == 0:
+                self._dequeue(user_key, ticket, served=True)
+            return wait
+    
+    def _finish(self, user_key: str, ticket: int, started: float, granted: bool) -> bool:
+        with self._lock:
+            if granted:
+                self._granted += 1
+                self._waits.append(time.monotonic() - started)
+            else:
+                self._dequeue(user_key, ticket, served=False)
+                self._timeouts += 1
+                print(f"✗ {self.provider.title()} rate limit queue wait exceeded for user {user_key}")
+        return granted
+    
+    async def _run(self, func, *args):
+        """Run a call that touches the store, on a worker thread when the store can block."""
+        if self.store.blocking:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+    
+    async def aacquire(self, tokens: int, user_key: str = None, max_wait: float = RATE_LIMIT_MAX_WAIT_SECONDS) -> bool:
+        """Wait until the call fits the provider's limits; False if max_wait is exceeded."""
+        if not self.enabled:
+            return True
+        user_key = user_key or current_user_key.get()
+        ticket = self._enqueue(user_key)
+        started = time.monotonic()
+        try:
+            while True:
+                wait = await self._run(self._try_acquire, user_key, ticket, tokens)
+                if wait == 0:
+                    return self._finish(user_key, ticket, started, True)
+                if time.monotonic() - started + wait > max_wait:
+                    return self._finish(user_key, ticket, started, False)
+                await asyncio.sleep(min(wait, 1.0))
+        except asyncio.CancelledError:
+            with self._lock:
+                self._dequeue(user_key, ticket, served=False)
+            raise
+    
+    async def asettle(self, reserved_tokens: int, actual_tokens: int):
+        """Correct the tokens bucket once the provider reports real usage."""
+        name = f"{self.provider}:tokens"
+        if name in self.limits and actual_tokens:
+            await self._run(self.store.adjust, name, reserved_tokens - actual_tokens, self.limits[name])
+    
+    async def apenalize(self, retry_after: float):
+        """Provider answered 429: hold back new calls for roughly retry_after seconds."""
+        with self._lock:
+            self._throttled += 1
+        for name, capacity in self.limits.items():
+            await self._run(self.store.adjust, name, -(capacity + retry_after * capacity / 60.0), capacity)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            depth = self._depth()
+        return {
+            "enabled": self.enabled,
+            "limits_per_minute": dict(self.limits),
+            "queue_depth": depth,
+            "max_queue_depth": self._max_depth,
+            "granted": self._granted,
+            "timeouts": self._timeouts,
+            "throttled_by_provider": self._throttled,
+            "avg_wait_seconds": round(sum(waits) / len(waits), 3) if waits else 0.0,
+            "p95_wait_seconds": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+            "max_wait_seconds": round(waits[-1], 3) if waits else 0.0
+        }
+
+def create_limiters_from_env() -> dict:
+    """Build one limiter per provider on the store selected by RATE_LIMIT_BACKEND."""
+    store = None
+    if RATE_LIMIT_BACKEND.lower() == "sqlite":
+        try:
+            store = SQLiteBucketStore()
+        except Exception as e:
+            print(f"✗ SQLite rate limit store unavailable ({e}), using in-process buckets")
+    if store is None:
+        store = MemoryBucketStore()
+    print(f"LLM rate limiter: {store.name}")
+    return {
+        provider: ProviderRateLimiter(provider, limits["rpm"], limits["tpm"], store)
+        for provider, limits in PROVIDER_LIMITS.items()
+    }
@@ -85,10 +85,15 @@ class ProjectListResponse(BaseModel):
 
 class GenerateContentRequest(BaseModel):
     section_id: Optional[int] = None  # If None, generate all sections
+    bypass_cache: bool = False  # Force fresh content instead of a cached response
+    batched: Optional[bool] = None  # Combine sections into a few prompts (default: server setting)
 
 class RefineContentRequest(BaseModel):
     section_id: int
     prompt: str
+    hedge: Optional[bool] = None  # Race a second provider when the first is slow (default: server setting)
+    target_blocks: Optional[List[int]] = None  # 0-based paragraphs/bullets to rewrite; others are only previewed
+    compact: Optional[bool] = None  # Send numbered blocks and apply edits (default: when blocks are targeted)
 
 class FeedbackRequest(BaseModel):
     section_id: int
@@ -99,6 +104,7 @@ class AITemplateRequest(BaseModel):
     document_type: str
     main_topic: str
     num_sections: Optional[int] = None  # For pptx, number of slides
+    bypass_cache: bool = False  # Force a fresh template instead of a cached response
 
 class SectionTemplate(BaseModel):
     title: str
@@ -106,3 +112,14 @@ class SectionTemplate(BaseModel):
 
 class AITemplateResponse(BaseModel):
     sections: List[SectionTemplate]  # List of section/slide templates
+
+class JobResponse(BaseModel):
+    id: str
+    project_id: int
+    kind: str
+    status: str
+    progress: dict = {}
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
@@ -0,0 +1,102 @@
+"""
+Per-slide render cache for PowerPoint exports.
+A rendered content slide is stored as its slide XML, the index of the layout it was
+built on, the images it embeds and the image URLs it claimed. An unchanged slide is spliced back into a new
+presentation instead of being rendered again, so an export after editing one section
+only renders that section's slide. Entries share ImageCache's content-addressed storage,
+so an image used by many cached slides is stored once.
+"""
+import hashlib
+import json
+import os
+from io import BytesIO
+from typing import Optional
+from lxml import etree
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+from pptx.oxml import parse_xml
+from image_cache import ImageCache
+
+SLIDE_CACHE_ENABLED = os.getenv("SLIDE_CACHE_ENABLED", "true").lower() == "true"
+SLIDE_CACHE_DIR = os.getenv("SLIDE_CACHE_DIR", "slide_cache")
+SLIDE_CACHE_MAX_BYTES = int(os.getenv("SLIDE_CACHE_MAX_MB", "200")) * 1024 * 1024
+# Slides keep the image chosen when they were rendered, so they expire sooner than images
+SLIDE_CACHE_TTL_SECONDS = int(os.getenv("SLIDE_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+R_NAMESPACE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+class SlideCache:
+    """Slide key -> (layout index, slide XML, embedded images, claimed image URLs)."""
+    
+    def __init__(self, store: ImageCache):
+        self.store = store
+    
+    @staticmethod
+    def make_key(section, style: dict) -> str:
+        """Hash of one section's title/content and every style input the slide depends on."""
+        payload = json.dumps({"title": section.title, "content": section.content, "style": style}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[dict]:
+        data = self.store.get(self.store.make_key(key, "slide"))
+        if not data:
+            return None
+        entry = json.loads(data)
+        media = {}
+        for r_id, digest in entry["media"].items():
+            blob = self.store.get(self.store.make_key(digest, "media"))
+            if blob is None:
+                # An image was evicted on its own; render the slide again
+                return None
+            media[r_id] = blob
+        entry["media"] = media
+        entry.setdefault("images", [])
+        return entry
+    
+    def put(self, key: str, slide, layout_index: int, images: list = ()):
+        """Store a rendered slide; `images` are the URLs/library keys its image was claimed under."""
+        media = {}
+        for r_id, rel in slide.part.rels.items():
+            if rel.reltype == RT.IMAGE and not rel.is_external:
+                blob = rel.target_part.blob
+                digest = hashlib.sha256(blob).hexdigest()
+                self.store.set(self.store.make_key(digest, "media"), blob, source="media")
+                media[r_id] = digest
+        entry = {
+            "layout": layout_index,
+            "xml": etree.tostring(slide.part._element, encoding="unicode"),
+            "media": media,
+            "images": list(images)
+        }
+        self.store.set(self.store.make_key(key, "slide"), json.dumps(entry).encode("utf-8"), source="slide")
+    
+    @staticmethod
+    def splice(prs, entry: dict):
+        """Append a cached slide: new slide on the same layout, images re-attached, XML swapped in."""
+        slide = prs.slides.add_slide(prs.slide_layouts[entry["layout"]])
+        new_ids = {}
+        for r_id, blob in entry["media"].items():
+            _, new_ids[r_id] = slide.part.get_or_add_image_part(BytesIO(blob))
+        element = parse_xml(entry["xml"].encode("utf-8"))
+        for node in element.iter():
+            for attribute in ("embed", "link", "id"):
+                name = f"{{{R_NAMESPACE}}}{attribute}"
+                if node.get(name) in new_ids:
+                    node.set(name, new_ids[node.get(name)])
+        slide.part._element = element
+    
+    def stats(self) -> dict:
+        return self.store.stats()
+
+def create_slide_cache_from_env() -> Optional[SlideCache]:
+    if not SLIDE_CACHE_ENABLED:
+        print("Slide cache: disabled")
+        return None
+    try:
+        cache = SlideCache(ImageCache(SLIDE_CACHE_DIR, SLIDE_CACHE_MAX_BYTES, SLIDE_CACHE_TTL_SECONDS))
+        print(f"Slide cache: {SLIDE_CACHE_DIR} ({SLIDE_CACHE_MAX_BYTES // (1024 * 1024)} MB)")
+        return cache
+    except Exception as e:
+        print(f"✗ Slide cache unavailable: {e}")
+        return None
+
+slide_cache = create_slide_cache_from_env()
@@ -6,8 +6,14 @@ from pptx import Presentation
 from docx import Document
 from io import BytesIO
 import os
+import threading
+import zipfile
+from collections import OrderedDict
 from typing import Optional, Dict, List
 
+# Templates kept in memory as uncompressed packages, keyed by path and mtime
+THEME_TEMPLATE_CACHE_MAX_BYTES = int(os.getenv("THEME_TEMPLATE_CACHE_MAX_MB", "64")) * 1024 * 1024
+
 class ThemeService:
     """Manage PowerPoint and Word design themes and templates."""
     
@@ -17,6 +23,11 @@ class ThemeService:
         self.builtin_ppt_themes = self._load_builtin_ppt_themes()
         self.builtin_word_themes = self._load_builtin_word_themes()
         
+        # path -> (mtime, bytes), least recently used first
+        self._template_cache = OrderedDict()
+        self._template_cache_bytes = 0
+        self._template_lock = threading.Lock()
+        
         # Create themes directories if they don't exist
         if not os.path.exists(self.themes_dir):
             os.makedirs(self.themes_dir)
@@ -256,39 +267,79 @@ class ThemeService:
         
         return word_theme_colors.get(theme_id, word_theme_colors["office"])
     
+    def get_template_path(self, theme_id: str, document_type: str = 'pptx') -> Optional[str]:
+        """Path of the custom template file for a theme, or None for built-in themes."""
+        if document_type == 'docx':
+            directory, extensions = self.word_themes_dir, ['.docx', '.dotx']
+        else:
+            directory, extensions = self.themes_dir, ['.pptx', '.potx']
+        
+        for ext in extensions:
+            custom_path = os.path.join(directory, f"{theme_id}{ext}")
+            if os.path.exists(custom_path):
+                return custom_path
+        return None
+    
     def load_theme_template(self, theme_id: str, document_type: str = 'pptx') -> Optional[any]:
         """Load a template by theme ID and document type."""
         try:
-            if document_type == 'pptx':
-                # Check if it's a custom PowerPoint theme file
-                custom_path = os.path.join(self.themes_dir, f"{theme_id}.pptx")
-                if os.path.exists(custom_path):
-                    return Presentation(custom_path)
-                
-                custom_path = os.path.join(self.themes_dir, f"{theme_id}.potx")
-                if os.path.exists(custom_path):
-                    return Presentation(custom_path)
-                
-                # For built-in themes, return None (will use default with colors)
-                return None
-            
-            elif document_type == 'docx':
-                # Check if it's a custom Word theme file
-                custom_path = os.path.join(self.word_themes_dir, f"{theme_id}.docx")
-                if os.path.exists(custom_path):
-                    return Document(custom_path)
-                
-                custom_path = os.path.join(self.word_themes_dir, f"{theme_id}.dotx")
-                if os.path.exists(custom_path):
-                    return Document(custom_path)
-                
-                # For built-in themes, return None (will use default with colors)
+            custom_path = self.get_template_path(theme_id, document_type)
+            # For built-in themes, return None (will use default with colors)
+            if not custom_path:
                 return None
             
+            # Each export gets its own copy, parsed from the cached bytes
+            template = BytesIO(self._read_template(custom_path))
+            if document_type == 'docx':
+                return Document(template)
+            return Presentation(template)
+        
         except Exception as e:
             print(f"Error loading theme {theme_id}: {e}")
             return None
     
+    @staticmethod
+    def _serialize_template(path: str) -> bytes:
+        """
+        Re-pack a template with uncompressed (stored) entries. Opening a package is mostly
+        inflating its parts, so loading from stored bytes skips that work on every export.
+        """
+        output = BytesIO()
+        with zipfile.ZipFile(path) as source, zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as target:
+            for info in source.infolist():
+                target.writestr(info.filename, source.read(info), zipfile.ZIP_STORED)
+        return output.getvalue()
+    
+    def _read_template(self, path: str) -> bytes:
+        """Serialized template, from memory unless the file changed since it was cached."""
+        mtime = os.path.getmtime(path)
+        with self._template_lock:
+            entry = self._template_cache.get(path)
+            if entry and entry[0] == mtime:
+                self._template_cache.move_to_end(path)
+                return entry[1]
+        
+        data = self._serialize_template(path)
+        with self._template_lock:
+            self._drop_template(path)
+            if len(data) <= THEME_TEMPLATE_CACHE_MAX_BYTES:
+                self._template_cache[path] = (mtime, data)
+                self._template_cache_bytes += len(data)
+                while self._template_cache_bytes > THEME_TEMPLATE_CACHE_MAX_BYTES:
+                    _, (_, evicted) = self._template_cache.popitem(last=False)
+                    self._template_cache_bytes -= len(evicted)
+        return data
+    
+    def _drop_template(self, path: str):
+        entry = self._template_cache.pop(path, None)
+        if entry:
+            self._template_cache_bytes -= len(entry[1])
+    
+    def invalidate_template(self, path: str):
+        """Forget a cached template after its file was replaced or removed."""
+        with self._template_lock:
+            self._drop_template(path)
+    
     def save_custom_theme(self, file_data: BytesIO, theme_name: str, document_type: str = 'pptx') -> bool:
         """Save a custom template (PowerPoint or Word)."""
         try:
@@ -308,10 +359,11 @@ class ThemeService:
             
             with open(filepath, 'wb') as f:
                 f.write(file_data.read())
+            self.invalidate_template(filepath)
             
             print(f"✓ Custom {document_type} theme saved: {safe_name}")
             return True
-            
+        
         except Exception as e:
             print(f"✗ Error saving theme: {e}")
             return False
@@ -330,6 +382,7 @@ class ThemeService:
                 filepath = os.path.join(directory, f"{theme_id}{ext}")
                 if os.path.exists(filepath):
                     os.remove(filepath)
+                    self.invalidate_template(filepath)
                     print(f"✓ Theme deleted: {theme_id}")
                     return True
             return False